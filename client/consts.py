@@ -2,3 +2,9 @@ HOST = '127.0.0.1'
 PORT = 5000
 ADDR = (HOST, PORT)
 FORMAT = 'utf-8'
+# seconds between heartbeats sent to keep the connection alive
+HEARTBEAT_INTERVAL = 30
+# the server answers every heartbeat; a connection it sent nothing on for this long is dead
+SERVER_TIMEOUT = 75
+# cached room history shown when entering a room, before the new messages
+HISTORY_TAIL_MESSAGES = 50
@@ -1,5 +1,7 @@
 import os.path
 import socket
+from typing import Any, Callable, Dict
+
 import messages
 
 
@@ -34,39 +36,52 @@ class FileTransfer:
             print("File to upload not found: " + self.file_path)
             raise FileNotFoundError(self.file_path)
 
-        # read file size
-        messages.send_message_json(
-            self.server,
-            {
-                "size": os.path.getsize(self.file_path),
-                "file_name": os.path.basename(self.file_path).split("/")[-1],
-            },
-        )
+        with messages.send_lock:
+            # read file size
+            messages.send_message_json(
+                self.server,
+                {
+                    "size": os.path.getsize(self.file_path),
+                    "file_name": os.path.basename(self.file_path).split("/")[-1],
+                },
+            )
 
-        # read file
-        with open(self.file_path, "rb") as file:
-            while True:
-                data = file.read(1024)
-                if not data:
-                    break
-                self.server.send(data)
+            # read file
+            with open(self.file_path, "rb") as file:
+                while True:
+                    data = file.read(1024)
+                    if not data:
+                        break
+                    self.server.send(data)
 
         print("File sent over")
 
-    def download_file_from_server(self, file_size: int) -> None:
+    def download_file_from_server(self, file_size: int, on_event: Callable[[Dict[str, Any]], None] = None) -> bool:
         """
-        Download a file from server to client
+        Download a file from server to client. The file comes in chunks,
+        each a header giving its size followed by its bytes; chat and other
+        events can arrive between them
 
         Args:
-            file_size (_type_): the size of the file to be downloaded
+            file_size (int): the size of the file to be downloaded
+            on_event (Callable): called with the events arriving meanwhile, shown by default
+
+        Returns:
+            bool: False when the server gave up sending the file, its reply was read
         """
         bytes_received = 0
         with open(self.file_path, "wb") as file:
-            # read all bytes until the first \0
-            while True:
-                if bytes_received >= file_size:
-                    break
-                bytes_to_read = file_size - bytes_received
-                data = self.server.recv(bytes_to_read)
-                bytes_received += len(data)
-                file.write(data)
+            while bytes_received < file_size:
+                frame = messages.receive_frame(self.server)
+                if "event" not in frame:
+                    return False
+                if frame["event"] != "file_chunk":
+                    (on_event or messages.print_event)(frame)
+                    continue
+                remaining = frame["size"]
+                while remaining > 0:
+                    data = messages.receive_bytes(self.server, remaining)
+                    remaining -= len(data)
+                    file.write(data)
+                bytes_received += frame["size"]
+        return True
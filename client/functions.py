@@ -1,11 +1,14 @@
 import select
 import socket
 import threading
+import time
 import traceback
-from typing import Optional
+from typing import Any, Callable, Dict, Optional
 from file_transfer import FileTransfer
-from consts import FORMAT
-from messages import receive_message_json, send_message_json
+from consts import HISTORY_TAIL_MESSAGES
+from history_cache import HistoryCache
+from messages import (has_buffered, print_event, receive_frame, receive_message_json, send_lock,
+                      send_message_json)
 
 
 def register(client: socket.socket, role: str) -> None:
@@ -34,10 +37,34 @@ def register(client: socket.socket, role: str) -> None:
         print(f"Registration failed - {response['error_message']}.")
 
 
+def show_event(event: Dict[str, Any], room_seqs: Dict[str, int]) -> None:
+    """
+    Show an event received while chatting. Chat lines are tagged with their
+    room once several rooms are joined, and lines the room's history already
+    showed are skipped.
+
+    Args:
+        event (Dict[str, Any]): The event
+        room_seqs (Dict[str, int]): Joined room -> number of the next message not shown yet
+    """
+    if event["event"] != "chat":
+        print_event(event)
+        return
+    room, messages = event["room"], event["messages"]
+    if room in room_seqs:
+        messages = messages[max(room_seqs[room] - event["seq"], 0):]
+        room_seqs[room] = max(room_seqs[room], event["seq"] + len(event["messages"]))
+    for message in messages:
+        if len(room_seqs) > 1:
+            message = f"[{room}] {message}"
+        print("\r< ", message + "\n> ", end="")
+
+
 def read_messages(
     connection: socket.socket,
     close_read_thread: threading.Event,
     read_lock: threading.Lock,
+    room_seqs: Dict[str, int],
 ) -> None:
     """
     Read incoming messages from the client and send them to the server.
@@ -48,6 +75,7 @@ def read_messages(
                                              or not the thread should stop.
         read_lock (threading.Lock): A lock that is used to synchronize the
                                     thread with other threads(for download).
+        room_seqs (Dict[str, int]): Joined room -> number of the next message not shown yet
     """
     while True:
         try:
@@ -56,9 +84,13 @@ def read_messages(
                 print("stopped reading incoming messages from channel")
                 break
             with read_lock:
-                if read_conn:
-                    message = connection.recv(1024).decode(FORMAT)
-                    print("\r< ", message + "\n> ", end="")
+                if read_conn or has_buffered():
+                    message = receive_frame(connection)
+                    if "event" in message:
+                        show_event(message, room_seqs)
+                    elif message["status_code"] != 200:
+                        # e.g. a rate limited message
+                        print("\r< ", f"Error - {message['error_message']}" + "\n> ", end="")
         except Exception as e:
             if isinstance(e, ConnectionError):
                 print("Connection closed by server.")
@@ -83,6 +115,8 @@ def login(client: socket.socket) -> None:
     if response["status_code"] == 200:
         role = response["role"]
         print(f"Logged-in as {role} successfully.")
+        for direct_message in response.get("direct_messages", []):
+            print(f"[direct] {direct_message['from']}: {direct_message['message']}")
         run_login_menu(client, role)
     else:
         print(f"Login failed - {response['error_message']}.")
@@ -116,6 +150,10 @@ def run_login_menu(client: socket.socket, role: str) -> None:
             do_create_chat_room(client)
         elif menu_selection == "5":
             do_delete_chat_room(client)
+        elif menu_selection == "6":
+            do_profile_server(client)
+        elif menu_selection == "7":
+            do_capture_traffic(client)
         elif menu_selection == "/exit":
             client.close()
             exit()
@@ -219,60 +257,107 @@ def do_delete_chat_room(client: socket.socket) -> None:
         print(f"Error deleting chat room - {response['error_message']}")
 
 
-def list_chat_rooms(client: socket.socket) -> Optional[str]:
+def do_profile_server(client: socket.socket) -> None:
     """
-    List all chat rooms
+    Run the server's sampling profiler for a number of seconds
 
     Args:
         client (socket.socket): The client socket
+    """
+    duration = input("Enter profiling duration in seconds: ")
+    data = {"action": "start_profiler", "duration": duration}
+    send_message_json(client, data)
+    response = receive_message_json(client)
+    if response["status_code"] == 200:
+        print(f"Profiling started, results will be written to {response['file_path']}")
+    else:
+        print(f"Error starting profiler - {response['error_message']}")
 
-    Returns:
-        Optional[str]: The list of chat rooms or None on error
+
+def do_capture_traffic(client: socket.socket) -> None:
+    """
+    Record the server's incoming requests for a number of seconds, for replaying later
+
+    Args:
+        client (socket.socket): The client socket
     """
-    data = {"action": "list_chat_rooms"}
+    duration = input("Enter capture duration in seconds: ")
+    data = {"action": "start_capture", "duration": duration}
     send_message_json(client, data)
     response = receive_message_json(client)
     if response["status_code"] == 200:
-        return response["rooms"]
+        print(f"Capture started, the trace will be written to {response['file_path']}")
     else:
-        return None
+        print(f"Error starting capture - {response['error_message']}")
 
 
-def upload_file(conn: socket.socket) -> None:
+def list_chat_rooms(client: socket.socket) -> Optional[str]:
+    """
+    List all chat rooms, asking for one page after the other
+
+    Args:
+        client (socket.socket): The client socket
+
+    Returns:
+        Optional[str]: The list of chat rooms or None on error
+    """
+    rooms = []
+    while True:
+        data = {"action": "list_chat_rooms", "offset": len(rooms)}
+        send_message_json(client, data)
+        response = receive_message_json(client)
+        if response["status_code"] != 200:
+            return None
+        rooms += response["rooms"]
+        if not response["rooms"] or len(rooms) >= response["total"]:
+            return rooms
+
+
+def upload_file(conn: socket.socket, on_event: Callable[[Dict[str, Any]], None]) -> None:
     """
     Upload a file
 
     Args:
         conn (socket.socket): The client socket
+        on_event (Callable): Shows the events arriving meanwhile
     """
     path_to_upload = input("Enter the path to upload: ")
     transfer = FileTransfer(conn, path_to_upload)
     transfer.upload_file()
-    response = receive_message_json(conn)
+    response = receive_message_json(conn, on_event)
     if response["status_code"] == 200:
         print("File uploaded successfully")
     else:
         print("Error uploading file")
 
 
-def download_file(conn: socket.socket) -> None:
+def download_file(conn: socket.socket, on_event: Callable[[Dict[str, Any]], None]) -> None:
     """
     Download a file
 
     Args:
         conn (socket.socket): The client socket
+        on_event (Callable): Shows the events arriving meanwhile
     """
-    message = receive_message_json(conn)
+    message = receive_message_json(conn, on_event)
+    if message["status_code"] != 200:
+        print(f"Error downloading file - {message['error_message']}")
+        return
     files = "\n".join(message["file_list"])
     file_name = input(f"Choose file from list: \n{files}\n")
     print(f"file name: {file_name}")
     send_message_json(conn, {"file_name": str(file_name)})
-    response = receive_message_json(conn)
+    response = receive_message_json(conn, on_event)
     print(f"response: {response}")
+    if response["status_code"] != 200:
+        print("Error downloading file")
+        return
     file_size = response["size"]
     transfer = FileTransfer(conn, file_name)
-    transfer.download_file_from_server(file_size)
-    response = receive_message_json(conn)
+    if not transfer.download_file_from_server(file_size, on_event):
+        print("Error downloading file")
+        return
+    response = receive_message_json(conn, on_event)
     if response["status_code"] == 200:
 
         print("File downloaded successfully")
@@ -280,50 +365,133 @@ def download_file(conn: socket.socket) -> None:
         print("Error downloading file")
 
 
-def do_enter_room(client: socket.socket, room_name: str) -> None:
+def join_room(client: socket.socket, room_name: str, room_seqs: Dict[str, int]) -> bool:
     """
-    Enter a room and allow the user to chat with other users in that room
+    Ask the server to add a room to this connection and replay its history.
+    History seen before comes from the local cache, only newer messages
+    are fetched, a page at a time. Chat from the room arriving meanwhile is
+    shown once the history is, without the lines it already showed
 
     Args:
         client (socket.socket): The client socket
-        room_name (str): The of the room to enter
+        room_name (str): The name of the room to join
+        room_seqs (Dict[str, int]): Joined room -> number of the next message not shown yet
+
+    Returns:
+        bool: Whether the room was joined
     """
-    enter_room_request = {"action": "enter_room", "room_name": room_name}
+    pending = []
+
+    def on_event(event: Dict[str, Any]) -> None:
+        if event["event"] == "chat" and event["room"] == room_name:
+            pending.append(event)
+        else:
+            show_event(event, room_seqs)
+
+    def read_history(since: int) -> Dict[str, Any]:
+        while True:
+            send_message_json(client, {"action": "room_history", "room_name": room_name, "since": since})
+            response = receive_message_json(client, on_event)
+            if "retry_after" not in response:
+                return response
+            # pages are rate limited like any other request; wait for the next one
+            time.sleep(response["retry_after"])
+
+    cache = HistoryCache(room_name)
+    since = cache.next_seq
+    enter_room_request = {"action": "enter_room", "room_name": room_name, "since": since}
     send_message_json(client, enter_room_request)
-    response = receive_message_json(client)
-    if response["status_code"] == 200:
-        print(f"Joined room: {room_name}")
-        print(f"Replaying chat messages from room {room_name}")
+    response = receive_message_json(client, on_event)
+    if response["status_code"] != 200:
+        print(f"Error entering chat room - {response['error_message']}")
+        return False
+    print(f"Joined room: {room_name}")
+    print(f"Replaying chat messages from room {room_name}")
+    first_seq = response["next_seq"] - len(response["messages"])
+    if response["incarnation"] != cache.incarnation or first_seq < since:
+        # the room was deleted and created again, or its history started over
+        cache.reset(response["incarnation"])
+        if since > 0 and first_seq >= since:
+            # the reply continued from where the old history ended
+            response = read_history(0)
+    for message in cache.tail(HISTORY_TAIL_MESSAGES):
+        print(message)
+    while response["status_code"] == 200:
         for message in response["messages"]:
             print(message)
-        print("\nReplayed all messages")
+        cache.append(response["messages"], response["next_seq"])
+        if response["complete"]:
+            break
+        response = read_history(cache.next_seq)
+    if response["status_code"] != 200:
+        print(f"Error replaying chat room - {response['error_message']}")
+    print("\nReplayed all messages")
+    room_seqs[room_name] = cache.next_seq
+    for event in pending:
+        show_event(event, room_seqs)
+    return True
+
+
+def do_enter_room(client: socket.socket, room_name: str) -> None:
+    """
+    Enter a room and allow the user to chat with other users in that room.
+    More rooms can be joined on the same connection with /join; messages are
+    sent to the room joined last and incoming ones are tagged with their room.
+
+    Args:
+        client (socket.socket): The client socket
+        room_name (str): The of the room to enter
+    """
+    room_seqs: Dict[str, int] = {}
+    if join_room(client, room_name, room_seqs):
         print("use /help to see available commands")
+        joined_rooms = [room_name]
 
+        def on_event(event: Dict[str, Any]) -> None:
+            show_event(event, room_seqs)
 
         close_read_thread = threading.Event()
         read_lock = threading.Lock()
         read_thread = threading.Thread(
-            target=read_messages, args=(client, close_read_thread, read_lock)
+            target=read_messages, args=(client, close_read_thread, read_lock, room_seqs)
         )
         read_thread.start()
         while True:
             message = input("> ")
-            if message:
-                send_message_json(client, {"action": "new_message", "message": message})
+            if message.startswith("/join "):
+                new_room = message[len("/join "):].strip()
+                if new_room in joined_rooms:
+                    joined_rooms.remove(new_room)
+                    joined_rooms.append(new_room)
+                    print(f"Sending to room: {new_room}")
+                else:
+                    with send_lock, read_lock:
+                        if join_room(client, new_room, room_seqs):
+                            joined_rooms.append(new_room)
+            elif message.startswith("/dm "):
+                _, _, rest = message.partition(" ")
+                recipient, _, text = rest.partition(" ")
+                with send_lock:
+                    send_message_json(client, {"action": "direct_message", "to": recipient, "message": text})
+            elif message:
+                # file transfers are multi-step exchanges, keep heartbeats out of them
+                # and their replies away from the read thread
+                with send_lock, read_lock:
+                    if message == "/exit":
+                        for joined_room in joined_rooms:
+                            send_message_json(client, {"action": "new_message", "message": message, "room_name": joined_room})
+                    else:
+                        send_message_json(client, {"action": "new_message", "message": message, "room_name": joined_rooms[-1]})
+                    if message == "/upload":
+                        upload_file(client, on_event)
+                    elif message == "/download":
+                        download_file(client, on_event)
                 if message == "/help":
-                    print("Available commands:\n/help\n/exit\n/upload\n/download")
+                    print("Available commands:\n/help\n/join <room>\n/dm <user> <message>\n/exit\n/upload\n/download")
                 elif message == "/exit":
                     close_read_thread.set()
                     read_thread.join()
                     break
-                elif message == "/upload":
-                    with read_lock:
-                        upload_file(client)
-                elif message == "/download":
-                    with read_lock:
-                        download_file(client)
-    else:
-        print(f"Error entering chat room - {response['error_message']}")
 
 
 def print_user_chat_menu() -> None:
@@ -345,4 +513,6 @@ def print_admin_chat_menu() -> None:
     print("3. List logged in users")
     print("4. Create a new chat room")
     print("5. Delete a chat room")
+    print("6. Profile the server")
+    print("7. Capture server traffic")
     print("/exit to exit")
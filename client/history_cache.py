@@ -0,0 +1,114 @@
+import json
+import os
+from typing import List, Optional
+from urllib.parse import quote
+
+from consts import FORMAT, HOST, PORT
+
+
+class HistoryCache:
+    """
+    On-disk cache of a room's history, so entering a room again only fetches
+    the messages sent since the last visit
+
+    The messages are kept in an append-only file, one JSON string per line,
+    next to a small index holding the server's number for the next message,
+    the length of the file that is known to be complete and the id of the
+    room's incarnation on the server, which changes when the room is
+    deleted and created again. The index is
+    replaced atomically after every append, so a write cut short by a crash
+    is simply cut off again on the next load.
+
+    Args:
+        room_name (str): the name of the room
+    """
+
+    cache_folder = "cache"
+
+    def __init__(self, room_name: str):
+        folder = os.path.join(self.cache_folder, f"{HOST}_{PORT}")
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, quote(room_name, safe=""))
+        self.log_path = base + ".log"
+        self.index_path = base + ".idx"
+        self.next_seq = 0
+        self.size = 0
+        self.incarnation: Optional[str] = None
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding=FORMAT) as f:
+                index = json.load(f)
+            next_seq, size = int(index["next_seq"]), int(index["size"])
+            incarnation = index.get("incarnation")
+        except (OSError, ValueError, KeyError, TypeError):
+            self.reset()
+            return
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except OSError:
+            log_size = -1
+        if log_size < size:
+            self.reset()
+            return
+        if log_size > size:
+            os.truncate(self.log_path, size)
+        self.next_seq, self.size, self.incarnation = next_seq, size, incarnation
+
+    def reset(self, incarnation: Optional[str] = None) -> None:
+        """
+        Forget the cached history, e.g. when the room was recreated on the server
+
+        Args:
+            incarnation (Optional[str]): the id of the room's history cached from now on
+        """
+        with open(self.log_path, "wb"):
+            pass
+        self.next_seq, self.size, self.incarnation = 0, 0, incarnation
+        self._save_index()
+
+    def _save_index(self) -> None:
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding=FORMAT) as f:
+            json.dump({"next_seq": self.next_seq, "size": self.size, "incarnation": self.incarnation}, f)
+        os.replace(temp_path, self.index_path)
+
+    def append(self, messages: List[str], next_seq: int) -> None:
+        """
+        Add messages fetched from the server
+
+        Args:
+            messages (List[str]): the messages, oldest first
+            next_seq (int): the number the server gives the message after them
+        """
+        data = "".join(json.dumps(message) + "\n" for message in messages).encode(FORMAT)
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+        self.size += len(data)
+        self.next_seq = next_seq
+        self._save_index()
+
+    def tail(self, count: int) -> List[str]:
+        """
+        Read the last cached messages without reading the whole file
+
+        Args:
+            count (int): how many messages to read at most
+
+        Returns:
+            List[str]: the messages, oldest first
+        """
+        if count <= 0 or self.size == 0:
+            return []
+        with open(self.log_path, "rb") as f:
+            end = self.size
+            data = b""
+            # one more newline than messages, unless the file start is reached
+            while end > 0 and data.count(b"\n") <= count:
+                start = max(end - 64 * 1024, 0)
+                f.seek(start)
+                data = f.read(end - start) + data
+                end = start
+        lines = data.splitlines()
+        return [json.loads(line) for line in lines[-count:]]
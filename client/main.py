@@ -1,8 +1,9 @@
 import socket
+import threading
 from consts import ADDR
 
 from functions import login, register
-from messages import send_message
+from messages import send_heartbeats, send_message
 
 CLIENT_OPTIONS = "Please choose an action:\n1. Register\n2. Login\n3. Exit\n4. Register As Admin"
 
@@ -13,6 +14,9 @@ def start_client():
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect(ADDR)
+        threading.Thread(
+            target=send_heartbeats, args=(client_socket,), daemon=True
+        ).start()
         while True:
             print(CLIENT_OPTIONS)
             choice = input("Enter your choice (1-4): ")
@@ -1,40 +1,174 @@
 import json
+import select
 import socket
-from typing import Any
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple
 
-from consts import FORMAT
+from consts import FORMAT, HEARTBEAT_INTERVAL, SERVER_TIMEOUT
+
+# Held while sending, and for the whole of multi-step exchanges such as file
+# transfers, so heartbeats never end up in the middle of one.
+send_lock = threading.RLock()
+
+# bytes received from the server after the last JSON value handed out; only
+# one thread reads at a time (see read_lock in functions.do_enter_room)
+_buffer = b""
+_decoder = json.JSONDecoder()
+# when bytes from the server were last read
+_heard_at = time.monotonic()
 
 
 def send_message(client: socket.socket, message: str) -> None:
     """
     Utility function to send encoded messages to the server.
     """
-    client.send(message.encode(FORMAT))
+    with send_lock:
+        client.send(message.encode(FORMAT))
 
 
 def send_message_json(client: socket.socket, message: str) -> None:
     """
     Utility function to send encoded messages to the server.
     """
-    client.send(json.dumps(message).encode(FORMAT))
+    with send_lock:
+        client.send(json.dumps(message).encode(FORMAT))
+
+
+def send_heartbeats(client: socket.socket) -> None:
+    """
+    Periodically ping the server so it does not drop the connection as idle.
+    The server answers with a pong; when nothing at all arrived from it for
+    SERVER_TIMEOUT, the connection is shut down so the client stops waiting
+    on a dead server. Runs until the connection is closed.
+    """
+    global _heard_at
+    unread = 0
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        # outside chat nobody reads the connection, pongs pile up unread instead
+        pending = _unread_bytes(client)
+        if pending is None:
+            return
+        if pending > unread:
+            _heard_at = time.monotonic()
+        unread = pending
+        if time.monotonic() - _heard_at > SERVER_TIMEOUT:
+            print("\rThe server stopped responding, disconnecting")
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        try:
+            send_message_json(client, {"action": "ping"})
+        except OSError:
+            return
+
+
+def _unread_bytes(client: socket.socket) -> Any:
+    """Bytes received from the server but not read yet (up to 64 KiB), or None once it closed the connection."""
+    try:
+        readable, _, _ = select.select([client], [], [], 0)
+        if not readable:
+            return 0
+        data = client.recv(65536, socket.MSG_PEEK)
+    except (OSError, ValueError):
+        return None
+    return len(data) if data else None
 
 
 def receive_message(client_socket: socket.socket) -> str:
     """
     Utility function to receive and decode messages from the server.
     """
-    return client_socket.recv(1024).decode(FORMAT)
+    return receive_bytes(client_socket, 1024).decode(FORMAT, errors="replace")
 
 
-def receive_message_json(client_socket: socket.socket) -> Any:
+def has_buffered() -> bool:
+    """Whether bytes already received are waiting to be read."""
+    return bool(_buffer)
+
+
+def receive_message_json(
+    client_socket: socket.socket,
+    on_event: Callable[[Dict[str, Any]], None] = None,
+) -> Any:
     """
-    Utility function to receive and decode messages from the server.
+    Receive the server's reply to the last request. Events the server pushes
+    on its own, e.g. chat or a direct message, can arrive first; they are
+    handed to on_event (shown by default) and skipped.
     """
-    full_message = ""
     while True:
-        message = client_socket.recv(1024).decode(FORMAT)
-        full_message += message
-        if message is None or len(message) < 1024:
-            break
+        message = receive_frame(client_socket)
+        if isinstance(message, dict) and "event" in message:
+            (on_event or print_event)(message)
+            continue
+        return message
+
+
+def receive_frame(client_socket: socket.socket) -> Any:
+    """
+    Receive the next JSON value the server sent. Whatever arrived after it
+    stays buffered for the next call.
+    """
+    global _buffer, _heard_at
+    while True:
+        if _buffer.lstrip()[:1] not in (b"", b"{", b"["):
+            # not JSON, show it as it is up to the next JSON value
+            start = _buffer.find(b"{")
+            text, _buffer = (_buffer, b"") if start < 0 else (_buffer[:start], _buffer[start:])
+            print(text.decode(FORMAT, errors="replace"))
+            continue
+        message, end = _decode(_buffer)
+        if end:
+            _buffer = _buffer[end:]
+            return message
+        data = client_socket.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed by server")
+        _heard_at = time.monotonic()
+        _buffer += data
+
+
+def receive_bytes(client_socket: socket.socket, size: int) -> bytes:
+    """
+    Receive up to `size` raw bytes, e.g. file data following a chunk
+    header, starting with those already buffered.
+    """
+    global _buffer, _heard_at
+    if _buffer:
+        data, _buffer = _buffer[:size], _buffer[size:]
+        return data
+    data = client_socket.recv(size)
+    if not data:
+        raise ConnectionError("Connection closed by server")
+    _heard_at = time.monotonic()
+    return data
+
+
+def _decode(data: bytes) -> Tuple[Any, int]:
+    """Decode the JSON value data starts with, returning it and its length in bytes, or (None, 0) if incomplete."""
+    stripped = data.lstrip()
+    try:
+        text = stripped.decode(FORMAT)
+    except UnicodeDecodeError as e:
+        # raw bytes, e.g. of a file, follow the JSON
+        text = stripped[:e.start].decode(FORMAT)
+    try:
+        message, end = _decoder.raw_decode(text)
+    except json.JSONDecodeError:
+        return None, 0
+    return message, len(data) - len(stripped) + len(text[:end].encode(FORMAT))
+
 
-    return json.loads(full_message)
+def print_event(event: Dict[str, Any]) -> None:
+    """Show an event the server pushed on its own."""
+    if event["event"] == "chat":
+        for message in event["messages"]:
+            print(f"\r[{event['room']}] {message}")
+    elif event["event"] == "direct_message":
+        print(f"\r[direct] {event['from']}: {event['message']}")
+    elif event["event"] == "presence":
+        room = f" {event['room']}" if "room" in event else ""
+        print(f"\r[presence] {event['user']} {event['status']}{room}")
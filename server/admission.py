@@ -0,0 +1,50 @@
+import threading
+from typing import Dict, Optional
+
+from consts import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP
+from metrics import metrics
+
+
+class AdmissionController:
+    """
+    Caps the number of concurrently served connections, globally and per
+    remote IP, so a connection storm is shed at accept time instead of
+    exhausting threads and file descriptors.
+    """
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, max_per_ip: int = MAX_CONNECTIONS_PER_IP):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self._active = 0
+        self._per_ip: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        metrics.register_gauge("connections_active", lambda: self._active)
+
+    def admit(self, ip: str) -> Optional[str]:
+        """Reserve a slot for a new connection. Returns the reason it was refused, or None."""
+        with self._lock:
+            if self._active >= self.max_connections:
+                return "global_limit"
+            if self._per_ip.get(ip, 0) >= self.max_per_ip:
+                return "ip_limit"
+            self._active += 1
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            return None
+
+    def reserve(self, ip: str) -> None:
+        """Count a connection admitted by the previous server generation, whatever the limits."""
+        with self._lock:
+            self._active += 1
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+
+    def release(self, ip: str) -> None:
+        with self._lock:
+            self._active -= 1
+            count = self._per_ip.get(ip, 0) - 1
+            if count > 0:
+                self._per_ip[ip] = count
+            else:
+                self._per_ip.pop(ip, None)
+
+
+admission = AdmissionController()
@@ -1,20 +1,30 @@
 import csv
-import hashlib
+import threading
+
+from password_hasher import password_hasher
 
 # User management functions (previously outlined)
 
+# serializes writers of users.csv (appends and full rewrites)
+users_file_lock = threading.Lock()
+
 
 def hash_password(password):
     """Hash a password for storing."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    return password_hasher.hash(password)
 
 
 def register_user(username, password, role):
-    """Register a new user with a hashed password and role."""
+    """Register a new user with a hashed password and role. Returns False when the name is taken."""
     password_hash = hash_password(password)
-    with open("database/users.csv", "a", newline="", encoding="utf-8") as file:
-        writer = csv.writer(file)
-        writer.writerow([username, password_hash, role])
+    with users_file_lock:
+        # checked again, another registration of the name may have won while hashing
+        if user_exists(username):
+            return False
+        with open("database/users.csv", "a", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow([username, password_hash, role])
+    return True
 
 
 def user_exists(username):
@@ -26,17 +36,32 @@ def user_exists(username):
                 return True
     return False
 
-def change_password(username, password):
-    """Change a user's password."""
-    password_hash = hash_password(password)
+
+def verify_password(username, password):
+    """Check a user's password. Returns (valid, stored hash should be upgraded)."""
     with open("database/users.csv", "r", encoding="utf-8") as file:
         reader = csv.reader(file)
-        data = list(reader)
-        for row in data:
+        for row in reader:
             if row[0] == username:
-                row[1] = password_hash
-                break
-    with open("database/users.csv", "w", newline='', encoding="utf-8") as file:
-        writer = csv.writer(file)
-        writer.writerows(data)
+                return password_hasher.verify(password, row[1])
+    return False, False
+
+
+def change_password(username, password):
+    """Change a user's password."""
+    set_password_hash(username, hash_password(password))
+
 
+def set_password_hash(username, password_hash):
+    """Store a new password hash for a user."""
+    with users_file_lock:
+        with open("database/users.csv", "r", encoding="utf-8") as file:
+            reader = csv.reader(file)
+            data = list(reader)
+            for row in data:
+                if row[0] == username:
+                    row[1] = password_hash
+                    break
+        with open("database/users.csv", "w", newline='', encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerows(data)
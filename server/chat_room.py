@@ -1,95 +1,134 @@
+import itertools
+import json
 import os.path
 import threading
-import time
-from typing import Dict
-from messages import send_failure
+from typing import Any, Dict, List, Optional, Tuple
+
+from connection import PRIORITY_CHAT, Connection
+from file_transfer import FileTransfer
+from logger import logger
+from presence import presence
+from room_log import RoomLog
+from search_index import RoomIndex
 
 from user_client import UserClient
 
 
+def _count_files(room_name: str) -> int:
+    files_folder = os.path.join(FileTransfer.download_folder, room_name)
+    return len(os.listdir(files_folder)) if os.path.isdir(files_folder) else 0
+
+
 class ChatRoom:
-    message_rate_limit: int = 10
+    __slots__ = ("name", "clients", "broadcast_lock", "log", "log_lock", "search_index")
+
     def __init__(self, name: str):
         self.name = name
-        self.clients: Dict[str, UserClient] = {}
+        # keyed by connection (each has one UserClient), a user may be in the room on several
+        self.clients: Dict[Connection, UserClient] = {}
         self.broadcast_lock = threading.Lock()
+        self.log = RoomLog(name)
+        # keeps log order and index order identical
+        self.log_lock = threading.Lock()
+        self.search_index = RoomIndex(name, self.log)
+        self.log.on_retention = self.search_index.prune
 
     def add_client(self, client: UserClient) -> None:
-        if client.name not in self.clients:
-            self.clients[client.name] = client
+        self.clients.setdefault(client.conn, client)
+        client.join(self.name)
 
     def remove_client(self, client: UserClient) -> None:
-        if client.name in self.clients:
-            del self.clients[client.name]
+        self.clients.pop(client.conn, None)
+        client.leave(self.name)
 
     def log_message(self, message: str) -> None:
-        with open("logs/chat_room_" + self.name + ".log", "a+", encoding="utf-8") as f:
-            f.write(message + "\n")
-
-    def get_log(self) -> None:
-        file_name = "logs/chat_room_" + self.name + ".log"
-        if not os.path.isfile(file_name):
-            return []
-        else:
-            with open(file_name, "r", encoding="utf-8") as f:
-                messages = f.readlines()
-                messages = [line.strip() for line in messages]
-            return messages
-
-    def replay_log(self, client: UserClient) -> None:
-        file_name = "logs/chat_room_" + self.name + ".log"
-        if not os.path.isfile(file_name):
-            client.conn.send(
-                "replaying all messages from the group chat\n".encode("utf-8")
-            )
-            client.conn.send("done replaying messages.".encode("utf-8"))
-        else:
-            client.conn.send(
-                            "replaying all messages from the group chat\n".encode("utf-8")
-                        )
-            with open(file_name, "r", encoding="utf-8") as f:
-                for line in f.readlines():
-                    try:
-                        client.conn.send((line.strip() + "\n").encode("utf-8"))
-                    except Exception as e:
-                        print(
-                            f"Failed to send message to {client.name} ({e}), removing client from list"
-                        )
-            client.conn.send("done replaying messages.".encode("utf-8"))
+        self.log_messages([message])
 
-    def check_if_user_passed_message_rate_limit(self, user: UserClient) -> bool:
-        if len(user.rolling_last_message_time) == user.rolling_last_message_time.maxlen:
-            if user.rolling_last_message_time[-1] > time.time() - 30:
-                return True
-        return False
+    def log_messages(self, messages: List[str]) -> int:
+        """Append messages to the log and the search index; returns the number of the first."""
+        lines = [message + "\n" for message in messages]
+        with self.log_lock:
+            locations = self.log.append_many(lines)
+            for (number, offset), line in zip(locations, lines):
+                self.search_index.add(number, offset, line)
+        return locations[0][0]
 
-    def update_last_message_time(self, user):
-        user.rolling_last_message_time.append(time.time())
+    def get_metadata(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "members": len({client.name for client in list(self.clients.values())}),
+            "last_activity": self.log.last_activity(),
+            "message_count": self.log.message_count(),
+            "files": _count_files(self.name),
+        }
+
+    @staticmethod
+    def dormant_metadata(name: str) -> Dict[str, Any]:
+        """get_metadata() of a room that is not materialized, without building it."""
+        message_count, last_activity = RoomLog.summary(name)
+        return {
+            "name": name,
+            "members": 0,
+            "last_activity": last_activity,
+            "message_count": message_count,
+            "files": _count_files(name),
+        }
+
+    def get_log(self, since: int = 0, limit: Optional[int] = None) -> Tuple[int, List[str]]:
+        """
+        The retained messages numbered >= since, at most `limit` of them, and
+        the number following the last of them, from which a client asks for
+        the next page, or for what is new next time it enters the room.
+        """
+        if since > self.log.end_number():
+            # numbers of a log that was since deleted, start over
+            since = 0
+        next_number = since
+        messages = []
+        for number, _, line in itertools.islice(self.log.iter_messages(since), limit):
+            messages.append(line.strip())
+            next_number = number + 1
+        return next_number, messages
 
     def broadcast(self, message: str, sender: UserClient) -> None:
-        if self.check_if_user_passed_message_rate_limit(sender):
-            send_failure(sender.conn, f"You can only send {sender.rolling_last_message_time.maxlen} messages every 30 seconds")
-            return
-        self.update_last_message_time(sender)
-        
-        self.log_message(sender.name + ":" + message)
+        self.broadcast_many([message], sender)
+
+    def broadcast_many(self, messages: List[str], sender: UserClient) -> None:
+        """
+        Log a burst of messages in one append and send them to each member as
+        one chat event. It carries the room, for members that joined several,
+        and the log number of the first message, so a client replaying the
+        room's history can tell which messages it already has.
+        """
         clients_to_remove = []
-        for name, client in self.clients.items():
-            if name != sender.name:
-                try:
-                    with self.broadcast_lock:
-                        client.conn.send((sender.name + ": " + message).encode("utf-8"))
-                except Exception as e:
-                    print(
-                        f"Failed to send message to user: {client.name} ({e}), removing client from list"
-                    )
-                    clients_to_remove.append(name)
+        # frames are only queued on each member's connection, so a slow member
+        # does not hold up the room; the lock keeps delivery in log order
+        with self.broadcast_lock:
+            first_number = self.log_messages([sender.name + ":" + message for message in messages])
+            frame = json.dumps({
+                "event": "chat",
+                "room": self.name,
+                "seq": first_number,
+                "messages": [sender.name + ": " + message for message in messages],
+            }).encode("utf-8")
+            for client in list(self.clients.values()):
+                # the sender's other connections get it too
+                if client is not sender:
+                    try:
+                        client.conn.post(frame, PRIORITY_CHAT)
+                    except Exception as e:
+                        logger.warning("broadcast_send_failed", user=client.name, room=self.name, error=e)
+                        clients_to_remove.append(client)
 
         # remove dead clients from list
-        for name in clients_to_remove:
-            disconnected_client = self.clients.pop(name)
+        for disconnected_client in clients_to_remove:
+            if self.clients.pop(disconnected_client.conn, None) is None:
+                # its own handler already noticed and cleaned up
+                continue
+            disconnected_client.leave(self.name)
+            presence.leave_room(disconnected_client.conn, self.name)
             try:
                 disconnected_client.conn.close()
-                print("Client disconnected successfully on deletion")
+                logger.info("dead_client_removed", user=disconnected_client.name, room=self.name)
             except Exception as e:
-                print(f"Failed to close connection with {disconnected_client.name} ({e})")
+                logger.warning("close_failed", user=disconnected_client.name, error=e)
@@ -0,0 +1,377 @@
+import heapq
+import json
+import os
+import select
+import socket
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+from consts import (FORMAT, IDLE_TIMEOUT, MAX_REQUEST_SIZE, OUTBOX_MAX_BYTES,
+                    TCP_KEEPALIVE_COUNT, TCP_KEEPALIVE_IDLE,
+                    TCP_KEEPALIVE_INTERVAL)
+from metrics import metrics
+
+_decoder = json.JSONDecoder()
+
+# frame classes, written in this order when several are waiting
+PRIORITY_CONTROL = 0  # replies and events
+PRIORITY_CHAT = 1
+PRIORITY_BULK = 2  # file data
+# the rest of a frame a post() could only write in part; it must go out next
+_PRIORITY_REMAINDER = -1
+
+# pipe that becomes readable to interrupt every interruptible wait for input
+_interrupt_pipe: Optional[Tuple[int, int]] = None
+_interrupt_lock = threading.Lock()
+
+
+class ReadInterrupted(Exception):
+    """Raised by interruptible reads after interrupt_reads() was called."""
+
+
+def _interrupt_fd() -> int:
+    global _interrupt_pipe
+    with _interrupt_lock:
+        if _interrupt_pipe is None:
+            _interrupt_pipe = os.pipe()
+            os.set_blocking(_interrupt_pipe[0], False)
+        return _interrupt_pipe[0]
+
+
+def interrupt_reads() -> None:
+    """Wake every thread waiting in wait_for_input(); waits fail until resume_reads()."""
+    _interrupt_fd()
+    os.write(_interrupt_pipe[1], b"x")
+
+
+def resume_reads() -> None:
+    try:
+        while os.read(_interrupt_fd(), 1024):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def wait_for_input(sock: socket.socket) -> None:
+    """
+    Block until `sock` is readable, honouring its timeout. Raises
+    ReadInterrupted instead when reads are interrupted, even if input is
+    waiting, so the caller stops at a request boundary.
+    """
+    interrupt_fd = _interrupt_fd()
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    poller.register(interrupt_fd, select.POLLIN)
+    timeout = sock.gettimeout()
+    ready = {fd for fd, _ in poller.poll(None if timeout is None else timeout * 1000)}
+    if interrupt_fd in ready:
+        raise ReadInterrupted()
+    if not ready:
+        raise socket.timeout("timed out")
+
+
+def enable_keepalive(sock: socket.socket) -> None:
+    """Turn on TCP keepalive with our own timings where the platform supports tuning them."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (
+        ("TCP_KEEPIDLE", TCP_KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", TCP_KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", TCP_KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        # also bound how long sent data may stay unacknowledged by a vanished peer
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(IDLE_TIMEOUT * 1000))
+
+
+class _Waiter:
+    __slots__ = ("done", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self.done.set()
+
+
+class _Outbox:
+    """
+    Frames waiting to be written and the thread writing them; only created
+    once a frame has to wait. The writer thread exits once it has emptied the
+    queue and is started again by the next frame that has to wait.
+    """
+
+    __slots__ = ("frames", "size", "sequence", "wakeup", "writer")
+
+    def __init__(self, lock: threading.Lock):
+        # heap of (priority, sequence, data, waiter); waiter is None for posted frames
+        self.frames: List[Tuple[int, int, bytes, Optional[_Waiter]]] = []
+        # bytes of posted frames; a sent one is bounded by its sender waiting for it
+        self.size = 0
+        self.sequence = 0
+        self.wakeup = threading.Condition(lock)
+        self.writer: Optional[threading.Thread] = None
+
+
+class Connection:
+    """
+    A client socket plus a receive buffer. Requests are JSON objects sent
+    back to back without a delimiter, so several (e.g. a heartbeat and a
+    request) may arrive in one recv; read_json splits them and keeps the rest
+    buffered, and recv hands out buffered bytes before reading the socket.
+    Also remembers when the peer was last heard from, for idle reaping.
+
+    Outgoing frames are scheduled by class. send() writes a frame and waits
+    for it, in the caller's thread when nothing more urgent is queued.
+    post() writes a frame (chat from other users, events) without waiting:
+    as much of it as the socket takes right away, queueing the rest; a
+    writer thread drains the queue while it is not empty, control frames
+    first, then chat, then file data. Every frame is a JSON value (file data follows the header of
+    its chunk within the frame), so frames never need to be split and can
+    go out in any order between them: chat is not held up by a download
+    going out in chunks. A peer that lets more than OUTBOX_MAX_BYTES of
+    posted frames pile up is disconnected.
+    """
+
+    __slots__ = (
+        "sock", "last_activity", "in_request", "_buffer",
+        "_lock", "_outbox", "_writing", "_closed",
+    )
+
+    def __init__(self, sock: socket.socket, buffer: bytes = b""):
+        self.sock = sock
+        self.last_activity = time.monotonic()
+        # True while the server is handling one of this connection's requests
+        self.in_request = False
+        self._buffer = buffer
+        self._lock = threading.Lock()
+        self._outbox: Optional[_Outbox] = None
+        # True while some thread is writing to the socket
+        self._writing = False
+        self._closed = False
+
+    def read_json(self, interruptible: bool = False) -> Any:
+        """
+        Return the next JSON request, or None when the peer closed the connection.
+        An interruptible read raises ReadInterrupted instead of waiting for more input
+        while reads are interrupted.
+        """
+        while True:
+            if self._buffer.strip():
+                try:
+                    text = self._buffer.decode(FORMAT)
+                except UnicodeDecodeError as e:
+                    # a split multi-byte character, or raw bytes following the request
+                    text = self._buffer[: e.start].decode(FORMAT)
+                start = len(text) - len(text.lstrip())
+                try:
+                    request, end = _decoder.raw_decode(text, start)
+                except json.JSONDecodeError:
+                    if len(self._buffer) > MAX_REQUEST_SIZE:
+                        raise
+                else:
+                    self._buffer = self._buffer[len(text[:end].encode(FORMAT)):]
+                    return request
+            if interruptible:
+                wait_for_input(self.sock)
+            data = self.sock.recv(1024)
+            if not data:
+                return None
+            self.last_activity = time.monotonic()
+            self._buffer += data
+
+    def recv(self, size: int) -> bytes:
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        data = self.sock.recv(size)
+        self.last_activity = time.monotonic()
+        return data
+
+    def buffered_input(self) -> bytes:
+        """Bytes received from the peer but not consumed yet."""
+        return self._buffer
+
+    def wait_flushed(self, timeout: float) -> bool:
+        """Wait until every queued frame was written. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._closed or (not self._writing and (self._outbox is None or not self._outbox.frames)):
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def send(self, data: bytes, priority: int = PRIORITY_CONTROL) -> int:
+        """Write a frame, waiting until it is on the wire."""
+        waiter = None
+        with self._lock:
+            if self._closed:
+                raise OSError("connection is closed")
+            outbox = self._outbox
+            if self._writing or (outbox is not None and outbox.frames and outbox.frames[0][0] <= priority):
+                waiter = _Waiter()
+                self._push(priority, data, waiter)
+            else:
+                self._writing = True
+        if waiter is not None:
+            waiter.done.wait()
+            if waiter.error is not None:
+                raise waiter.error
+            return len(data)
+        try:
+            self.sock.sendall(data)
+        except Exception as e:
+            self._fail(e)
+            raise
+        finally:
+            self._done_writing()
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+    def post(self, data: bytes, priority: int = PRIORITY_CHAT) -> None:
+        """Write a frame without waiting for the peer, queueing what the socket does not take now."""
+        with self._lock:
+            if self._closed:
+                raise OSError("connection is closed")
+            outbox = self._outbox
+            if self._writing or (outbox is not None and outbox.frames):
+                if outbox is None or outbox.size + len(data) <= OUTBOX_MAX_BYTES:
+                    self._push(priority, data, None)
+                    return
+                full = True
+            else:
+                full = False
+                self._writing = True
+        if full:
+            error = OSError("peer is not reading, outbox is full")
+            metrics.increment("connections_slow_dropped")
+            self._fail(error)
+            raise error
+        try:
+            written = self._write_nowait(data)
+        except Exception as e:
+            self._done_writing()
+            self._fail(e)
+            raise
+        if written == len(data):
+            self._done_writing()
+            return
+        with self._lock:
+            self._writing = False
+            if not self._closed:
+                self._push(_PRIORITY_REMAINDER, data[written:], None)
+
+    def _write_nowait(self, data: bytes) -> int:
+        """Write as much of `data` as the socket takes without blocking; returns the bytes written."""
+        view = memoryview(data)
+        written = 0
+        try:
+            while written < len(data):
+                if self.sock.gettimeout() is None:
+                    written += self.sock.send(view[written:], socket.MSG_DONTWAIT)
+                else:
+                    # a socket with a timeout is non-blocking underneath, and its
+                    # send() would wait for room instead of returning
+                    written += os.write(self.sock.fileno(), view[written:])
+        except BlockingIOError:
+            pass
+        return written
+
+    def _push(self, priority: int, data: bytes, waiter: Optional[_Waiter]) -> None:
+        """Queue a frame and make sure a writer thread is there to write it. Caller holds the lock."""
+        outbox = self._outbox
+        if outbox is None:
+            outbox = self._outbox = _Outbox(self._lock)
+        heapq.heappush(outbox.frames, (priority, outbox.sequence, data, waiter))
+        outbox.sequence += 1
+        if waiter is None:
+            outbox.size += len(data)
+        if outbox.writer is None:
+            outbox.writer = threading.Thread(target=self._write_queued, daemon=True)
+            outbox.writer.start()
+        else:
+            outbox.wakeup.notify()
+
+    def _next_frame(self) -> Optional[Tuple[int, int, bytes, Optional[_Waiter]]]:
+        """The frame to write next, if one may be written now. Caller holds the lock."""
+        frames = self._outbox.frames
+        if self._writing or not frames:
+            return None
+        frame = heapq.heappop(frames)
+        if frame[3] is None:
+            self._outbox.size -= len(frame[2])
+        return frame
+
+    def _write_queued(self) -> None:
+        """Writer thread: drains the outbox until it is empty or the connection closes."""
+        outbox = self._outbox
+        while True:
+            with self._lock:
+                frame = self._next_frame()
+                # another thread is writing; wait for it unless nothing is left to write after it
+                while frame is None and outbox.frames and not self._closed:
+                    outbox.wakeup.wait()
+                    frame = self._next_frame()
+                if frame is None:
+                    outbox.writer = None
+                    return
+                self._writing = True
+            _, _, data, waiter = frame
+            error = None
+            try:
+                self.sock.sendall(data)
+            except Exception as e:
+                error = e
+                self._fail(e)
+            finally:
+                self._done_writing()
+            if waiter is not None:
+                waiter.finish(error)
+
+    def _done_writing(self) -> None:
+        with self._lock:
+            self._writing = False
+            if self._outbox is not None and self._outbox.frames:
+                self._outbox.wakeup.notify()
+
+    def _fail(self, error: BaseException) -> None:
+        """Stop writing for good: fail the frames still queued and wake the handler thread."""
+        waiters = []
+        with self._lock:
+            self._closed = True
+            outbox = self._outbox
+            if outbox is not None:
+                waiters = [frame[3] for frame in outbox.frames if frame[3] is not None]
+                outbox.frames.clear()
+                outbox.size = 0
+                outbox.wakeup.notify_all()
+        for waiter in waiters:
+            waiter.finish(error)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self) -> Optional[float]:
+        return self.sock.gettimeout()
+
+    def shutdown(self, how: int = socket.SHUT_RDWR) -> None:
+        self.sock.shutdown(how)
+
+    def close(self) -> None:
+        self._fail(OSError("connection is closed"))
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
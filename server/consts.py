@@ -3,3 +3,99 @@ HOST = "127.0.0.1"
 PORT = 5000
 ADDR = (HOST, PORT)
 FORMAT = "utf-8"
+
+# Logging
+LOG_LEVEL = 20  # INFO
+LOG_QUEUE_SIZE = 10000
+# event name -> fraction of records kept
+LOG_SAMPLE_RATES = {"request": 0.01}
+
+# Room logs
+ROOM_LOG_SEGMENT_BYTES = 4 * 1024 * 1024
+ROOM_LOG_SEGMENT_SECONDS = 24 * 60 * 60
+# defaults for rooms without their own retention settings (None = unlimited)
+ROOM_LOG_RETENTION_DAYS = None
+ROOM_LOG_RETENTION_BYTES = 256 * 1024 * 1024
+LOG_MAINTENANCE_INTERVAL = 60
+
+# Rate limiting: (bucket capacity, tokens refilled per second)
+RATE_LIMIT_USER_BUCKET = (10, 0.5)
+RATE_LIMIT_IP_BUCKET = (30, 2)
+# token cost per action (or chat command); anything else costs 1
+RATE_LIMIT_ACTION_COSTS = {
+    "exit": 0,
+    "login": 3,
+    "register": 5,
+    "change_password": 3,
+    "search": 2,
+    # per page of history, like the enter_room that returned the first one
+    "room_history": 1,
+    # per batch; its messages are charged to the batch bucket
+    "new_messages": 1,
+    "/exit": 0,
+    "/upload": 5,
+    "/download": 3,
+}
+
+# messages sent in new_messages batches, per user: (bucket capacity, messages
+# refilled per second); apart from the user bucket, so relays can carry more
+# than a person types
+RATE_LIMIT_BATCH_BUCKET = (100, 20)
+
+# most messages accepted in one new_messages request; a larger batch would
+# never fit in the batch bucket
+MAX_MESSAGE_BATCH = int(RATE_LIMIT_BATCH_BUCKET[0])
+
+# Admission control
+LISTEN_BACKLOG = 128
+MAX_CONNECTIONS = 1000
+MAX_CONNECTIONS_PER_IP = 50
+# seconds a new connection gets to log in before it is dropped
+LOGIN_TIMEOUT = 120
+# retry hint sent to connections refused while the server is busy
+BUSY_RETRY_AFTER = 5
+
+# Heartbeats and idle connections
+MAX_REQUEST_SIZE = 1024 * 1024
+# connections not heard from (requests or pings) for this many seconds are dropped
+IDLE_TIMEOUT = 90
+REAPER_TICK = 1
+TCP_KEEPALIVE_IDLE = 60
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 5
+
+# Outgoing frames
+# chat and events queued for a connection that is not reading; beyond this it is dropped
+OUTBOX_MAX_BYTES = 4 * 1024 * 1024
+# file data goes out in frames of this size, so chat and replies can go out in between
+FILE_CHUNK_BYTES = 64 * 1024
+# messages per reply when replaying a room's history; clients ask for the rest with room_history
+HISTORY_PAGE_MESSAGES = 500
+# room names per list_chat_rooms reply when the request sets no limit, and the most it may ask for
+LIST_ROOMS_PAGE_SIZE = 100
+LIST_ROOMS_MAX_PAGE_SIZE = 500
+
+# Password hashing
+# worker processes running the KDF; login throughput scales with this
+PASSWORD_HASH_WORKERS = 2
+# hashes queued or running at once; further logins wait for a slot
+PASSWORD_HASH_MAX_PENDING = 64
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# Direct messages
+# direct messages kept for an offline user; older ones are dropped first
+MAILBOX_MAX_MESSAGES = 500
+
+# Rooms
+# rooms nobody is in are unloaded after this many seconds without being accessed
+ROOM_IDLE_SECONDS = 600
+ROOM_EVICT_INTERVAL = 60
+
+# Zero-downtime upgrades
+# Unix socket a new server generation (started with --takeover) connects to,
+# in a folder only the server's user can enter
+UPGRADE_SOCKET = "upgrade/upgrade.sock"
+# seconds to wait for in-flight requests before giving an upgrade up
+UPGRADE_DRAIN_TIMEOUT = 10
@@ -1,6 +1,8 @@
 import csv
 import os
 
+from logger import logger
+
 
 class DatabaseController:
     def __init__(self) -> None:
@@ -10,7 +12,7 @@ class DatabaseController:
         self.initialize_group_database()
         self.initialize_logs()
         self.initialize_files()
-        print("DatabaseController initialized")
+        logger.info("database_initialized")
 
     def initialize_user_database(self):
         if not os.path.exists("database/users.csv"):
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List
+from urllib.parse import quote
+
+from consts import MAILBOX_MAX_MESSAGES
+from logger import logger
+
+
+class Mailbox:
+    """
+    Direct messages waiting for users who were offline when they were sent,
+    one JSON-lines file per user under database/mailboxes/. A mailbox is
+    read and removed when its owner logs in. `lock` is held by senders while
+    they decide between live delivery and the mailbox, and by logins while
+    draining, so a message can never land in a mailbox that was just drained.
+    """
+
+    folder = "database/mailboxes"
+
+    def __init__(self, max_messages: int = MAILBOX_MAX_MESSAGES):
+        self.max_messages = max_messages
+        self.lock = threading.RLock()
+        # username -> messages in the mailbox, filled in lazily
+        self._counts: Dict[str, int] = {}
+
+    def _path(self, username: str) -> str:
+        return os.path.join(self.folder, quote(username, safe="") + ".jsonl")
+
+    def deposit(self, username: str, message: Dict[str, Any]) -> None:
+        path = self._path(username)
+        with self.lock:
+            if username not in self._counts:
+                self._counts[username] = len(self._read(path))
+            if self._counts[username] >= self.max_messages:
+                # full: drop the oldest messages
+                kept = self._read(path)[-(self.max_messages - 1):] if self.max_messages > 1 else []
+                with open(path, "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(m) + "\n" for m in kept)
+                self._counts[username] = len(kept)
+                logger.warning("mailbox_full", username=username)
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(message) + "\n")
+            self._counts[username] += 1
+
+    def drain(self, username: str) -> List[Dict[str, Any]]:
+        """Return and remove every message waiting for a user, oldest first."""
+        path = self._path(username)
+        with self.lock:
+            messages = self._read(path)
+            if messages:
+                os.remove(path)
+            self._counts.pop(username, None)
+            return messages
+
+    @staticmethod
+    def _read(path: str) -> List[Dict[str, Any]]:
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+mailbox = Mailbox()
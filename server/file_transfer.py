@@ -1,5 +1,8 @@
+import json
 import os.path
 import socket
+from connection import PRIORITY_BULK
+from consts import FILE_CHUNK_BYTES, FORMAT
 from messages import send_success
 
 class FileTransfer:
@@ -34,12 +37,13 @@ class FileTransfer:
                 
         send_success(self.sender, data={"size": os.path.getsize(self.file_path), "file_name": os.path.basename(self.file_path).split('/')[-1] })
 
-        # read file
+        # read file, each chunk goes out behind a header giving its size
         with open(self.file_path, "rb") as file:
             while True:
-                data = file.read(1024)
+                data = file.read(FILE_CHUNK_BYTES)
                 if not data:
                     break
-                self.sender.send(data)
+                header = json.dumps({"event": "file_chunk", "size": len(data)}).encode(FORMAT)
+                self.sender.send(header + data, PRIORITY_BULK)
 
         
\ No newline at end of file
@@ -1,56 +1,67 @@
 import csv
-import json
-import os.path
+import math
 import socket
-from typing import Any, Dict, Optional, Set
+import sys
+import time
+from typing import Any, Optional
 
 import auth
 from chat_room import ChatRoom
-from consts import FORMAT
+from connection import Connection
+from consts import (HISTORY_PAGE_MESSAGES, LIST_ROOMS_MAX_PAGE_SIZE,
+                    LIST_ROOMS_PAGE_SIZE, MAX_MESSAGE_BATCH)
+from direct_messages import mailbox
 from user_client import UserClient
 from file_transfer import FileTransfer
-from messages import send_success, send_failure
+from logger import logger
+from messages import send_event, send_success, send_failure
+from metrics import metrics
+from presence import presence
+from profiler import profiler, slow_request_monitor
+from room_log import retention_settings
+from room_registry import room_registry
+from traffic_capture import traffic_capture
 
-chat_rooms: Dict[str, ChatRoom] = {}
+# name -> room; rooms are loaded on first access
+chat_rooms = room_registry
 
 def load_chat_rooms_from_groups():
-    if os.path.isfile("database/groups.csv"):
-        with open("database/groups.csv", "r") as f:
-            reader = csv.reader(f, delimiter=",")
-            next(reader)
-            for row in reader:
-                name = row[0]
-                chat_rooms[row[0]] = ChatRoom(name)
-
-def get_message_json(conn: socket.socket) -> Any:
-    request = conn.recv(1024).decode(FORMAT)
-    if not request:
-        print("Client terminated")
-        return
-    return json.loads(request)
+    room_registry.load()
+
+def get_message_json(conn: Connection) -> Any:
+    request = conn.read_json()
+    # heartbeats may arrive in the middle of a multi-step exchange
+    while request is not None and request.get("action") == "ping":
+        send_event(conn, "pong")
+        request = conn.read_json()
+    if request is None:
+        logger.info("client_terminated")
+    elif traffic_capture.running:
+        traffic_capture.exchange(conn, request)
+    return request
 
 
 def register(conn: socket.socket, request) -> None:
     """Registers the user with the given username and password."""
-    print(f"Registering a new user. User name: {request['username']} Password: {request['password']}.\n")
+    logger.info("register", username=request['username'], role=request['role'])
 
-    if auth.user_exists(request['username']):
-        print(f"Failed to register user {request['username']}. User already exists.")
+    # checked before hashing too, so taken names are turned away without paying for the KDF
+    if auth.user_exists(request['username']) or not auth.register_user(
+        request['username'], request['password'], request['role']
+    ):
+        logger.info("register_failed", username=request['username'], reason="exists")
         send_failure(conn, "Username already exists")
     else:
-        auth.register_user(request['username'], request['password'], request['role'])
         send_success(conn)
 
 
 def validate_login(username: str, password: str) -> bool:
-    """Validate a user's login credentials."""
-    password_hash = auth.hash_password(password)
-    with open("database/users.csv", "r", encoding="utf-8") as file:
-        reader = csv.reader(file)
-        for row in reader:
-            if row[0] == username and row[1] == password_hash:
-                return True
-    return False
+    """Validate a user's login credentials, upgrading a legacy password hash on success."""
+    valid, needs_rehash = auth.verify_password(username, password)
+    if valid and needs_rehash:
+        auth.change_password(username, password)
+        logger.info("password_rehashed", username=username)
+    return valid
 
 def change_password(conn: socket.socket, username: str, password: str) -> None:
     if not auth.user_exists(username):
@@ -69,130 +80,360 @@ def get_user_role(username: str) -> Optional[str]:
     return None
 
 
-def list_logged_users(conn: socket.socket):
-    users_list = list_users(chat_rooms)
+def list_logged_users(conn: socket.socket, request: Any) -> None:
+    """List users connected to a room, or every logged-in user with scope "online"."""
+    if request.get("scope") == "online":
+        users_list = presence.online_users()
+    else:
+        users_list = presence.users_in_rooms()
     send_success(conn, {
-        "users": list(users_list)
+        "users": users_list,
+        "count": len(users_list)
     })
 
-def upload_file(conn: socket.socket, room_name: str) -> None:
-    request = conn.recv(1024).decode(FORMAT)
-    if not request:
-        print("Client terminated")
+
+def subscribe_presence(conn: socket.socket, request: Any) -> None:
+    """Start (or stop, with subscribe=false) pushing presence change events to the client."""
+    if request.get("subscribe", True):
+        presence.subscribe(conn)
+    else:
+        presence.unsubscribe(conn)
+    send_success(conn)
+
+def upload_file(conn: Connection, room_name: str) -> None:
+    data = get_message_json(conn)
+    if not data:
         return
-    data = json.loads(request)
     size = data["size"]
     file_name = data["file_name"]
     transfer = FileTransfer(conn, file_name, room_name)
     transfer.download_file_from_client(size)
     send_success(conn, data={"status_code": 200, "message": "done uploading file"})
 
-def download_file(conn: socket.socket, room_name: str) -> None:
+def discard_upload(conn: socket.socket) -> None:
+    """Read and throw away an upload the client already started sending (e.g. when it was rejected)."""
+    data = get_message_json(conn)
+    if not data:
+        return
+    remaining = data["size"]
+    while remaining > 0:
+        chunk = conn.recv(min(remaining, 65536))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+
+
+def download_file(conn: Connection, room_name: str) -> None:
     if not chat_rooms.get(room_name):
         send_failure(conn)
         return
+    # chat keeps flowing meanwhile, the file goes out in chunk frames it can go in between
     file_list = FileTransfer.get_file_names(room_name)
     send_success(conn, data={"file_list": file_list})
     message = get_message_json(conn)
-    print(f"got message: {message}")
+    logger.debug("download_request", room=room_name, request=message)
     file_name = message["file_name"]
-    
+
     transfer = FileTransfer(conn, file_name, room_name)
-    
 
     try:
-        
-        broadcast_lock = chat_rooms[room_name].broadcast_lock
-        with broadcast_lock:
-            transfer.upload_file_to_client()
-        
+        transfer.upload_file_to_client()
         send_success(conn)
     except Exception as e:
-        print(e)
+        logger.warning("download_failed", room=room_name, file_name=file_name, error=e)
         send_failure(conn)
 
 
-def list_chat_rooms(conn):
-    rooms = list_rooms()
-    send_success(conn, {"rooms": rooms})
+def list_chat_rooms(conn: socket.socket, request: Any) -> None:
+    """List rooms, optionally filtered by name prefix, paged and with per-room metadata."""
+    try:
+        offset = int(request.get("offset", 0))
+        limit = request.get("limit")
+        limit = LIST_ROOMS_PAGE_SIZE if limit is None else int(limit)
+    except (TypeError, ValueError):
+        send_failure(conn, "Offset and limit must be integers")
+        return
+    limit = min(limit, LIST_ROOMS_MAX_PAGE_SIZE)
+    names, total = room_registry.list(request.get("prefix", ""), offset, limit)
+    data = {"rooms": names, "total": total}
+    if request.get("details"):
+        data["room_details"] = room_registry.metadata(names)
+    send_success(conn, data)
 
 
 def create_room(conn: socket.socket, request: Any) -> None:
-    """Create a new chat room and add it to the groups.csv file."""
+    """Create a new chat room and persist it in the room registry."""
     name = request["room_name"]
-    print(f"Creating a new chat room: {name}")
-    with open("database/groups.csv", "r+", newline="\n", encoding="utf-8") as file:
-        existing_rooms = [line.strip() for line in file.readlines()]
-        if name in existing_rooms:
-            send_failure(conn, "Room already exists.")
-        else:
-            file.write(f"{name}\n")
-            chat_rooms[name] = ChatRoom(name)
-            send_success(conn)
+    logger.info("create_room", room=name)
+    if room_registry.create(name) is None:
+        send_failure(conn, "Room already exists.")
+    else:
+        send_success(conn)
 
 
 def delete_room(conn: socket.socket, request: Any) -> None:
-    """Delete a room and remove it from the groups.csv file."""
+    """Delete a room from the room registry along with its log."""
     name = request["chat_room_name"]
-    print(f"Deleting chat room: {name}")
-    with open("database/groups.csv", "r+", newline="\n", encoding="utf-8") as file:
-        if name not in chat_rooms:
-            send_failure(conn, "Chat room does not exist")
-        else:
-            rooms = [line for line in file if line.strip() != name]
-            file.truncate(0)
-            file.seek(0)
-            file.writelines(rooms)
-            chat_rooms.pop(name)
-            try:
-                os.remove("logs/chat_room_" + name + ".log")
-            except OSError:
-                print(f"Error: could not delete log for chat room {name}")
-            send_success(conn)
-
-
-def list_rooms():
-    """List all chat rooms from the groups.csv file."""
-    with open("database/groups.csv", "r", newline="", encoding="utf-8") as file:
-        reader = csv.reader(file)
-        next(reader)
-        rooms = [row[0] for row in reader]
-    return rooms
+    logger.info("delete_room", room=name)
+    room = room_registry.delete(name)
+    if room is None:
+        send_failure(conn, "Chat room does not exist")
+        return
+    for client in list(room.clients.values()):
+        client.leave(name)
+        presence.leave_room(client.conn, name)
+    room.search_index.drop()
+    retention_settings.remove(name)
+    try:
+        room.log.destroy()
+    except OSError:
+        logger.warning("delete_room_log_failed", room=name)
+    send_success(conn)
+
+
+def set_retention(conn: socket.socket, request: Any) -> None:
+    """Set how long (max_age_days) and how much (max_bytes) of a room's history is kept; null means unlimited."""
+    name = request.get("room_name")
+    if name not in chat_rooms:
+        send_failure(conn, "Chat room does not exist")
+        return
+    try:
+        max_age_days = request.get("max_age_days")
+        max_age_days = None if max_age_days is None else float(max_age_days)
+        max_bytes = request.get("max_bytes")
+        max_bytes = None if max_bytes is None else int(max_bytes)
+    except (TypeError, ValueError):
+        send_failure(conn, "max_age_days and max_bytes must be numbers")
+        return
+    retention_settings.set(name, max_age_days, max_bytes)
+    logger.info("set_retention", room=name, max_age_days=max_age_days, max_bytes=max_bytes)
+    send_success(conn)
+
+
+def search(conn: socket.socket, request: Any) -> None:
+    """Search a room's history for terms and "quoted phrases", optionally filtered by sender."""
+    room = chat_rooms.get(request.get("room_name"))
+    if room is None:
+        send_failure(conn, "You must specify a valid room name")
+        return
+    try:
+        offset = int(request.get("offset", 0))
+        limit = int(request.get("limit", 20))
+    except (TypeError, ValueError):
+        send_failure(conn, "Offset and limit must be integers")
+        return
+    results, has_more = room.search_index.search(
+        request.get("query", ""), request.get("sender"), offset, limit
+    )
+    send_success(conn, {"results": results, "has_more": has_more})
+
+
+def get_metrics(conn: socket.socket) -> None:
+    send_success(conn, metrics.snapshot())
+
 
+def start_profiler(conn: socket.socket, request: Any) -> None:
+    """Sample every handler thread for the requested number of seconds."""
+    try:
+        duration = float(request.get("duration", 10))
+    except (TypeError, ValueError):
+        send_failure(conn, "Duration must be a number of seconds")
+        return
+    if duration <= 0:
+        send_failure(conn, "Duration must be positive")
+        return
+    try:
+        file_path = profiler.start(duration)
+    except RuntimeError as e:
+        send_failure(conn, str(e))
+        return
+    logger.info("profiler_started", duration=duration, file_path=file_path)
+    send_success(conn, {"file_path": file_path})
+
+
+def start_capture(conn: socket.socket, request: Any) -> None:
+    """Record incoming requests to a trace file for the requested number of seconds."""
+    try:
+        duration = float(request.get("duration", 60))
+    except (TypeError, ValueError):
+        send_failure(conn, "Duration must be a number of seconds")
+        return
+    if duration <= 0:
+        send_failure(conn, "Duration must be positive")
+        return
+    try:
+        file_path = traffic_capture.start(duration)
+    except RuntimeError as e:
+        send_failure(conn, str(e))
+        return
+    logger.info("capture_started", duration=duration, file_path=file_path)
+    send_success(conn, {"file_path": file_path})
 
-def list_users(chat_rooms):
-    clients: Set[str] = set()
-    for room in chat_rooms:
-        for name, _ in chat_rooms[room].clients.items():
-            clients.add(name)
-    return clients
 
+def set_slow_request_log(conn: socket.socket, request: Any) -> None:
+    """Enable the slow request log with the given threshold, or disable it with null."""
+    threshold = request.get("threshold")
+    if threshold is not None:
+        try:
+            threshold = float(threshold)
+        except (TypeError, ValueError):
+            send_failure(conn, "Threshold must be a number of seconds")
+            return
+        # 0 or less would log a stack for every request
+        if not math.isfinite(threshold) or threshold <= 0:
+            send_failure(conn, "Threshold must be a positive number of seconds")
+            return
+    slow_request_monitor.set_threshold(threshold)
+    send_success(conn, {"threshold": threshold})
 
-def enter_room(conn: socket.socket, username: str, room_name: str) -> UserClient:
+
+def enter_room(conn: socket.socket, user: Optional[UserClient], username: str, room_name: str, since: int = 0) -> UserClient:
+    """
+    Join a room; a connection keeps one UserClient for all the rooms it joins.
+    Replays the history from message number `since`, clients that cache it
+    only ask for what they have not seen. The first HISTORY_PAGE_MESSAGES
+    come with the reply, room_history serves the rest.
+    """
     room = chat_rooms[room_name]
     if room is None:
         send_failure(conn, "Failed to join room.")
         return None
     else:
-        user = UserClient(username, conn)
+        if user is None:
+            user = UserClient(username, conn)
         room.add_client(user)
-        send_success(conn, {
-            "room": room_name,
-            "messages": room.get_log()
-        })
+        presence.enter_room(conn, room_name)
+        send_history(conn, room, since)
         return user
 
+
+def room_history(conn: socket.socket, user: Optional[UserClient], request: Any) -> None:
+    """The next page of the history of a room the connection is in."""
+    room_name = request.get("room_name")
+    since = request.get("since")
+    room = chat_rooms.get(room_name) if user is not None and room_name in user.rooms else None
+    if room is None:
+        return send_failure(conn, "You must be in the chat room to read its history")
+    if not isinstance(since, int) or since < 0:
+        return send_failure(conn, "since must be a message number")
+    send_history(conn, room, since)
+
+
+def send_history(conn: socket.socket, room: ChatRoom, since: int) -> None:
+    next_number, messages = room.get_log(since, HISTORY_PAGE_MESSAGES)
+    send_success(conn, {
+        "room": room.name,
+        # changes when the room is deleted and created again
+        "incarnation": room.log.incarnation(),
+        "messages": messages,
+        "next_seq": next_number,
+        "complete": next_number >= room.log.end_number(),
+    })
+
 def login(conn: socket, request: Any):
-    username = request["username"]
+    # one shared string for the presence index, the rooms and every connection of the user
+    username = sys.intern(request["username"])
     password = request["password"]
-    print(f"Logging in user: {username}")
     if validate_login(username, password):
         user_role = get_user_role(username)
-        print(f"Logged in successfully, user role: {user_role}")
-        send_success(conn, {
-            "role": user_role
-        })
+        logger.info("login", username=username, role=user_role)
+        # messages sent from now on go to the connection, earlier ones are in the mailbox
+        with mailbox.lock:
+            presence.login(username, conn)
+            direct_messages = mailbox.drain(username)
+        # a client that does not read must not hold up the senders of direct messages;
+        # one sent meanwhile arrives as an event, which clients accept before the reply
+        send_success(conn, {"role": user_role, "direct_messages": direct_messages})
         return user_role
     else:
+        logger.info("login_failed", username=username)
         send_failure(conn, "Invalid username or password.")
         return None
+
+
+def addressed_room(request: Any, user: Optional[UserClient], current_room: Optional[ChatRoom]) -> Optional[ChatRoom]:
+    """The joined room a chat request is for: the one named by room_name, else the room entered last."""
+    room_name = request.get("room_name")
+    if room_name is None and current_room is not None:
+        room_name = current_room.name
+    if user is None or room_name not in user.rooms:
+        return None
+    return chat_rooms.get(room_name)
+
+
+def send_messages(conn: socket.socket, room: ChatRoom, user: UserClient, request: Any) -> None:
+    """Broadcast a batch of chat messages (e.g. relayed by a bot) as one log append and one frame per member."""
+    messages = request.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return send_failure(conn, "You must specify a list of messages")
+    if len(messages) > MAX_MESSAGE_BATCH:
+        return send_failure(conn, f"At most {MAX_MESSAGE_BATCH} messages can be sent at once")
+    if not all(
+        isinstance(message, str) and message and not message.startswith("/") and "\n" not in message
+        for message in messages
+    ):
+        return send_failure(conn, "Batched messages must be non-empty single lines and cannot be commands")
+    room.broadcast_many(messages, user)
+
+
+def direct_message(conn: socket.socket, sender: str, request: Any) -> None:
+    """Send a private message to every connection of a user, or to their mailbox while they are offline."""
+    recipient = request.get("to")
+    message = request.get("message")
+    if not recipient or not isinstance(message, str) or not message:
+        return send_failure(conn, "You must specify a recipient and a message")
+    # reads the users file, keep it out of mailbox.lock; online users surely exist
+    if not presence.connections_of(recipient) and not auth.user_exists(recipient):
+        return send_failure(conn, "User does not exist")
+    entry = {"from": sender, "message": message, "sent_at": time.time()}
+    with mailbox.lock:
+        connections = presence.connections_of(recipient)
+        if not connections:
+            mailbox.deposit(recipient, entry)
+            return send_success(conn, {"delivered": False})
+    delivered = False
+    for target in connections:
+        try:
+            send_event(target, "direct_message", entry)
+            delivered = True
+        except Exception as e:
+            logger.warning("direct_message_send_failed", user=recipient, error=e)
+    if not delivered:
+        mailbox.deposit(recipient, entry)
+    send_success(conn, {"delivered": delivered})
+
+
+def exit_room(conn: socket.socket, room: ChatRoom, user: UserClient) -> None:
+    room.remove_client(user)
+    presence.leave_room(conn, room.name)
+
+
+def disconnect(conn: socket.socket) -> None:
+    """Remove every trace of a closed connection from the presence index and the rooms."""
+    _, rooms = presence.disconnect(conn)
+    for room_name in rooms:
+        room = chat_rooms.get(room_name)
+        if room is None:
+            continue
+        client = room.clients.get(conn)
+        if client is not None:
+            room.remove_client(client)
+
+
+def resume_session(conn: Connection, state: Any) -> Optional[UserClient]:
+    """Restore a session handed over by the previous server generation; returns its UserClient."""
+    user_name = state["user_name"]
+    if user_name is None:
+        return None
+    user_name = sys.intern(user_name)
+    presence.login(user_name, conn)
+    user = None
+    for room_name in state["rooms"]:
+        room = chat_rooms.get(room_name)
+        if room is None:
+            continue
+        if user is None:
+            user = UserClient(user_name, conn)
+        room.add_client(user)
+        presence.enter_room(conn, room_name)
+    return user
@@ -0,0 +1,232 @@
+import base64
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from connection import Connection, interrupt_reads, resume_reads
+from consts import UPGRADE_DRAIN_TIMEOUT, UPGRADE_SOCKET
+from heartbeat import idle_reaper
+from logger import logger
+from password_hasher import password_hasher
+from pause_gate import PauseGate
+from presence import presence
+from room_log import log_maintenance
+from room_registry import room_registry
+from search_index import index_saver
+
+# most descriptors passed in one message (the kernel allows 253)
+FDS_PER_MESSAGE = 200
+
+Session = Tuple[Connection, Tuple[str, int], Dict[str, Any]]
+
+
+def _send(sock: socket.socket, message: Dict[str, Any], fds: Sequence[int] = ()) -> None:
+    """Send a length-prefixed JSON message; descriptors travel with its header."""
+    body = json.dumps(message).encode("utf-8")
+    socket.send_fds(sock, [struct.pack("!I", len(body))], list(fds))
+    sock.sendall(body)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("upgrade socket closed")
+        data += chunk
+    return data
+
+
+def _recv(sock: socket.socket) -> Tuple[Dict[str, Any], List[int]]:
+    header, fds, _, _ = socket.recv_fds(sock, 4, FDS_PER_MESSAGE)
+    if not header:
+        raise ConnectionError("upgrade socket closed")
+    header += _recv_exactly(sock, 4 - len(header))
+    (size,) = struct.unpack("!I", header)
+    return json.loads(_recv_exactly(sock, size)), fds
+
+
+class Handoff:
+    """
+    Zero-downtime upgrades. A running server listens on UPGRADE_SOCKET and a
+    new generation started with --takeover connects to it. The old one then
+    stops at request boundaries: the accept loop and idle handlers park right
+    away, handlers serving a request finish it first. Once queued frames are
+    flushed, the listening socket and every client socket are passed over
+    with SCM_RIGHTS together with each session's state (login, rooms, input
+    received but not handled yet). When the new generation confirms it took
+    them over the old one exits; if anything fails before that, it resumes
+    serving and clients never notice either way. Background work (log
+    maintenance, room eviction, idle reaping, index saving) is paused
+    before the hand over, as the new generation starts its own on the same
+    files.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._handlers = 0
+        self._parked: Dict[Connection, Tuple[Tuple[str, int], Dict[str, Any]]] = {}
+        self._listener_parked = False
+        # bumped when an upgrade is abandoned, which releases the parked threads
+        self._attempt = 0
+        self._draining = False
+        # gates of the background threads paused for the upgrade in progress
+        self._paused: List[PauseGate] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def handler_started(self) -> None:
+        with self._lock:
+            self._handlers += 1
+
+    def handler_finished(self) -> None:
+        with self._lock:
+            self._handlers -= 1
+            self._lock.notify_all()
+
+    def park(self, conn: Connection, addr: Tuple[str, int], state: Dict[str, Any]) -> None:
+        """Called by a handler between requests once reads are interrupted; returns if the upgrade is abandoned."""
+        state = dict(
+            state,
+            buffer=base64.b64encode(conn.buffered_input()).decode("ascii"),
+            subscribed=presence.is_subscribed(conn),
+        )
+        with self._lock:
+            attempt = self._attempt
+            if not self._draining:
+                return
+            self._parked[conn] = (addr, state)
+            self._lock.notify_all()
+            while self._attempt == attempt:
+                self._lock.wait()
+
+    def park_listener(self) -> None:
+        """Called by the accept loop once reads are interrupted; returns if the upgrade is abandoned."""
+        with self._lock:
+            attempt = self._attempt
+            if not self._draining:
+                return
+            self._listener_parked = True
+            self._lock.notify_all()
+            while self._attempt == attempt:
+                self._lock.wait()
+
+    def start(self, listener: socket.socket) -> None:
+        """Accept upgrade requests for the server listening on `listener`."""
+        # bound inside a folder only this user can enter, so the socket is
+        # never reachable by others, not even before the chmod below
+        folder = os.path.dirname(UPGRADE_SOCKET)
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        os.chmod(folder, 0o700)
+        if os.path.exists(UPGRADE_SOCKET):
+            os.unlink(UPGRADE_SOCKET)
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.bind(UPGRADE_SOCKET)
+        os.chmod(UPGRADE_SOCKET, 0o600)
+        control.listen(1)
+        self._thread = threading.Thread(target=self._run, args=(control, listener), daemon=True)
+        self._thread.start()
+
+    def _run(self, control: socket.socket, listener: socket.socket) -> None:
+        while True:
+            peer, _ = control.accept()
+            try:
+                self._hand_over(peer, listener)
+            except Exception as e:
+                logger.warning("upgrade_failed", error=e)
+                self._resume()
+            finally:
+                peer.close()
+
+    def _hand_over(self, peer: socket.socket, listener: socket.socket) -> None:
+        message, _ = _recv(peer)
+        if message.get("type") != "takeover":
+            return
+        logger.info("upgrade_started")
+        deadline = time.monotonic() + UPGRADE_DRAIN_TIMEOUT
+        with self._lock:
+            self._draining = True
+        interrupt_reads()
+        with self._lock:
+            while not self._listener_parked or len(self._parked) < self._handlers:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("requests still in progress")
+                self._lock.wait(remaining)
+            parked = list(self._parked.items())
+        for gate in (log_maintenance.gate, room_registry.gate, idle_reaper.gate, index_saver.gate):
+            if not gate.pause(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError("background work still in progress")
+            self._paused.append(gate)
+        for conn, _ in parked:
+            if not conn.wait_flushed(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError("outgoing frames still queued")
+        index_saver.save_all()
+
+        _send(peer, {"type": "listener"}, [listener.fileno()])
+        for start in range(0, len(parked), FDS_PER_MESSAGE):
+            batch = parked[start:start + FDS_PER_MESSAGE]
+            _send(
+                peer,
+                {"type": "connections", "sessions": [dict(state, addr=list(addr)) for _, (addr, state) in batch]},
+                [conn.fileno() for conn, _ in batch],
+            )
+        _send(peer, {"type": "done"})
+        reply, _ = _recv(peer)
+        if reply.get("type") != "ready":
+            raise ConnectionError("the new generation did not take over")
+        logger.info("upgrade_handed_over", connections=len(parked))
+        password_hasher.shutdown()
+        logger.flush()
+        # parked threads and the sockets go with the process; the new generation owns them now
+        os._exit(0)
+
+    def _resume(self) -> None:
+        for gate in self._paused:
+            gate.resume()
+        self._paused.clear()
+        with self._lock:
+            self._draining = False
+            resume_reads()
+            self._parked.clear()
+            self._listener_parked = False
+            self._attempt += 1
+            self._lock.notify_all()
+        logger.info("upgrade_abandoned")
+
+    @staticmethod
+    def take_over() -> Tuple[socket.socket, socket.socket, List[Session]]:
+        """
+        Ask the running server to hand over. Returns the upgrade socket (to be
+        answered with confirm()), the listening socket and the client sessions.
+        """
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.connect(UPGRADE_SOCKET)
+        _send(peer, {"type": "takeover"})
+        listener = None
+        sessions: List[Session] = []
+        while True:
+            message, fds = _recv(peer)
+            if message["type"] == "listener":
+                listener = socket.socket(fileno=fds[0])
+            elif message["type"] == "connections":
+                for state, fd in zip(message["sessions"], fds):
+                    conn = Connection(socket.socket(fileno=fd), base64.b64decode(state["buffer"]))
+                    sessions.append((conn, tuple(state["addr"]), state))
+            elif message["type"] == "done":
+                break
+        if listener is None:
+            raise ConnectionError("no listening socket was handed over")
+        return peer, listener, sessions
+
+    @staticmethod
+    def confirm(peer: socket.socket) -> None:
+        """Tell the previous generation its sessions are served here now, so it exits."""
+        _send(peer, {"type": "ready"})
+        peer.close()
+
+
+handoff = Handoff()
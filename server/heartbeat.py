@@ -0,0 +1,71 @@
+import math
+import threading
+import time
+from typing import Optional
+
+from connection import Connection
+from consts import IDLE_TIMEOUT, REAPER_TICK
+from logger import logger
+from metrics import metrics
+from pause_gate import PauseGate
+from timing_wheel import TimingWheel
+
+
+class IdleReaper:
+    """
+    Drops connections whose peer has not been heard from for IDLE_TIMEOUT
+    seconds; clients keep idle connections alive by sending
+    {"action": "ping"} heartbeats. Every connection has one timer in a
+    timing wheel. Activity does not touch the wheel: when a timer fires
+    the connection's last activity is checked and the timer re-armed for
+    the remaining time, so each tick only costs O(expired timers).
+    Shutting a reaped socket down wakes its handler thread, whose normal
+    disconnect path removes it from rooms and presence.
+    """
+
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT, tick: float = REAPER_TICK):
+        self.idle_timeout = idle_timeout
+        self.wheel = TimingWheel(tick, math.ceil(idle_timeout / tick) + 1)
+        self.gate = PauseGate()
+        self._thread: Optional[threading.Thread] = None
+        metrics.register_gauge("connections_watched", lambda: len(self.wheel))
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def watch(self, conn: Connection) -> None:
+        self.wheel.schedule(conn, self.idle_timeout)
+
+    def forget(self, conn: Connection) -> None:
+        self.wheel.cancel(conn)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.wheel.tick)
+            with self.gate:
+                self._reap_idle(time.monotonic())
+
+    def _reap_idle(self, now: float) -> None:
+        for conn in self.wheel.advance(now):
+            idle = now - conn.last_activity
+            if conn.in_request:
+                # busy serving a request, which may legitimately take long (e.g. a download)
+                self.wheel.schedule(conn, self.idle_timeout, now)
+            elif idle < self.idle_timeout:
+                # heard from since the timer was armed
+                self.wheel.schedule(conn, self.idle_timeout - idle, now)
+            else:
+                self._reap(conn, idle)
+
+    def _reap(self, conn: Connection, idle: float) -> None:
+        logger.info("connection_reaped", idle=round(idle, 1))
+        metrics.increment("connections_reaped")
+        try:
+            conn.shutdown()
+        except OSError:
+            pass
+
+
+idle_reaper = IdleReaper()
@@ -0,0 +1,108 @@
+import atexit
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+from consts import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+# Fields whose values must never reach the log output
+SECRET_FIELDS = {"password", "password_hash", "new_password"}
+
+
+def redact(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a copy of `fields` with secret values masked (recursing into dicts)."""
+    redacted = {}
+    for key, value in fields.items():
+        if key in SECRET_FIELDS:
+            redacted[key] = "***"
+        elif isinstance(value, dict):
+            redacted[key] = redact(value)
+        else:
+            redacted[key] = value
+    return redacted
+
+
+class AsyncLogger:
+    """
+    Structured logger that keeps formatting and I/O off the calling thread.
+    Callers only enqueue a record; a background thread redacts, formats (one
+    JSON object per line) and writes it. High frequency events can be sampled
+    via `sample_rates` (event name -> fraction of records kept). When the queue
+    is full records are dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(
+        self,
+        level: int = INFO,
+        sample_rates: Optional[Dict[str, float]] = None,
+        max_queue: int = 10000,
+        stream: TextIO = sys.stdout,
+    ):
+        self.level = level
+        self.sample_rates = dict(sample_rates or {})
+        self.stream = stream
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, level: int, event: str, **fields: Any) -> None:
+        if level < self.level:
+            return
+        rate = self.sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        try:
+            self._queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self.log(INFO, event, **fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self.log(WARNING, event, **fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        self.log(ERROR, event, **fields)
+
+    def flush(self) -> None:
+        """Block until every record enqueued so far has been written."""
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            timestamp, level, event, fields = self._queue.get()
+            try:
+                record = {
+                    "ts": round(timestamp, 6),
+                    "level": LEVEL_NAMES.get(level, str(level)),
+                    "event": event,
+                }
+                record.update(redact(fields))
+                self.stream.write(json.dumps(record, default=str) + "\n")
+                if self._queue.empty():
+                    self.stream.flush()
+            except Exception:
+                # never let a bad record kill the writer thread
+                pass
+            finally:
+                self._queue.task_done()
+
+
+logger = AsyncLogger(LOG_LEVEL, LOG_SAMPLE_RATES, LOG_QUEUE_SIZE)
+atexit.register(logger.flush)
@@ -1,35 +1,109 @@
-import json
 import socket
+import sys
 import threading
+import time
 import traceback
-from typing import Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
+from admission import admission
 from chat_room import ChatRoom
-from consts import ADDR, FORMAT, HOST
+from connection import (Connection, ReadInterrupted, enable_keepalive,
+                        wait_for_input)
+from consts import ADDR, BUSY_RETRY_AFTER, HOST, LISTEN_BACKLOG, LOGIN_TIMEOUT
 from database_controller import DatabaseController
-from functions import (change_password, chat_rooms, create_room, delete_room,
-                       download_file, enter_room, list_chat_rooms,
+from functions import (addressed_room, change_password, chat_rooms,
+                       create_room, delete_room, direct_message,
+                       discard_upload, disconnect, download_file, enter_room,
+                       exit_room, get_metrics, list_chat_rooms,
                        list_logged_users, load_chat_rooms_from_groups, login,
-                       register, upload_file)
-from messages import send_failure
+                       register, resume_session, room_history, search,
+                       send_messages, set_retention, set_slow_request_log,
+                       start_capture, start_profiler, subscribe_presence,
+                       upload_file)
+from handoff import handoff
+from heartbeat import idle_reaper
+from logger import logger
+from messages import send_event, send_failure
+from metrics import metrics
+from presence import presence
+from profiler import slow_request_monitor
+from rate_limiter import rate_limiter
+from room_log import log_maintenance, retention_settings
+from room_registry import room_registry
+from traffic_capture import traffic_capture
 from user_client import UserClient
 
 
-def internal_handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
-    print(f"[NEW CONNECTION] {addr} connected.")
+def internal_handle_client(
+    conn: Connection,
+    addr: Tuple[str, int],
+    resumed: Optional[Tuple[Dict[str, Any], Optional[UserClient]]] = None,
+) -> None:
     role: Optional[str] = None
     user_name: Optional[str] = None
     user: Optional[UserClient] = None
     logged_room: Optional[ChatRoom] = None
     connected: bool = True
+    login_deadline = time.monotonic() + LOGIN_TIMEOUT
+    if resumed is None:
+        logger.info("connection_opened", addr=addr)
+    else:
+        # served by the previous server generation until it handed the connection over
+        state, user = resumed
+        role, user_name = state["role"], state["user_name"]
+        if state["room"] is not None:
+            logged_room = chat_rooms.get(state["room"])
+        if state["login_remaining"] is not None:
+            login_deadline = time.monotonic() + state["login_remaining"]
     while connected:
+        conn.in_request = False
+        slow_request_monitor.finish()
+        traffic_capture.finish(conn)
+        if role is None:
+            # connections that do not log in in time are dropped
+            conn.settimeout(max(login_deadline - time.monotonic(), 0.001))
+        elif conn.gettimeout() is not None:
+            conn.settimeout(None)
         # Receiving the request type from the client (registration or login)
-        raw_request = conn.recv(1024).decode(FORMAT)
-        if not raw_request:
-            print("Client terminated")
+        try:
+            request = conn.read_json(interruptible=True)
+        except ReadInterrupted:
+            # a new server generation is taking over; this is a request boundary
+            handoff.park(conn, addr, {
+                "role": role,
+                "user_name": user_name,
+                "rooms": list(user.rooms) if user is not None else [],
+                "room": logged_room.name if logged_room is not None else None,
+                "login_remaining": max(login_deadline - time.monotonic(), 0) if role is None else None,
+            })
+            continue
+        if request is None:
+            logger.info("client_terminated", addr=addr)
             break
-        request = json.loads(raw_request)
         action = request["action"]
+        if action == "ping":
+            # heartbeat, receiving it already refreshed the connection's activity;
+            # the pong tells the client the server is still there
+            send_event(conn, "pong")
+            continue
+        conn.in_request = True
+        if traffic_capture.running:
+            traffic_capture.begin(conn, request, user_name, role, user.rooms if user is not None else ())
+        retry_after = rate_limiter.check(request, user_name, addr[0])
+        if retry_after:
+            logger.info("rate_limited", addr=addr, user=user_name, action=action)
+            metrics.increment("requests_rate_limited")
+            if action == "new_message" and request.get("message") == "/upload":
+                discard_upload(conn)
+            send_failure(
+                conn,
+                f"Rate limit exceeded, retry after {retry_after:.1f} seconds",
+                {"retry_after": retry_after},
+            )
+            continue
+        metrics.increment("requests")
+        slow_request_monitor.start(action)
+        logger.info("request", addr=addr, action=action)
         if action == "register":
             register(conn, request)
         elif action == "login":
@@ -38,13 +112,20 @@ def internal_handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
                 user_name = request.get("username")
                 if user_name is None:
                     send_failure(conn, "You must specify a valid username")
+                elif traffic_capture.running:
+                    traffic_capture.session(conn, user_name, role)
         elif action == "exit":
             connected = False
             role = None
             conn.close()
             return
         elif action == "list_users":
-            list_logged_users(conn)
+            list_logged_users(conn, request)
+        elif action == "subscribe_presence":
+            if role is None:
+                send_failure(conn, "You must be logged in to subscribe to presence")
+                continue
+            subscribe_presence(conn, request)
         elif action == "create_chat_room":
             if role != "admin":
                 send_failure(conn, "Only admins can create chat rooms")
@@ -55,89 +136,212 @@ def internal_handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
                 send_failure(conn, "Only admins can delete chat rooms")
                 continue
             delete_room(conn, request)
+        elif action == "set_retention":
+            if role != "admin":
+                send_failure(conn, "Only admins can change room retention")
+                continue
+            set_retention(conn, request)
+        elif action == "get_metrics":
+            if role != "admin":
+                send_failure(conn, "Only admins can read server metrics")
+                continue
+            get_metrics(conn)
+        elif action == "start_profiler":
+            if role != "admin":
+                send_failure(conn, "Only admins can profile the server")
+                continue
+            start_profiler(conn, request)
+        elif action == "start_capture":
+            if role != "admin":
+                send_failure(conn, "Only admins can capture traffic")
+                continue
+            start_capture(conn, request)
+        elif action == "set_slow_request_log":
+            if role != "admin":
+                send_failure(conn, "Only admins can configure the slow request log")
+                continue
+            set_slow_request_log(conn, request)
         elif action == "list_chat_rooms":
-            list_chat_rooms(conn)
+            list_chat_rooms(conn, request)
+        elif action == "search":
+            if role is None:
+                send_failure(conn, "You must be logged in to search")
+                continue
+            search(conn, request)
         elif action == "enter_room":
             room_name = request.get("room_name")
             if not room_name or room_name not in chat_rooms:
                 send_failure(conn, "You must specify a valid room name")
                 continue                
-            user = enter_room(conn, user_name, room_name)
-            if user is not None:
+            since = request.get("since", 0)
+            if not isinstance(since, int) or since < 0:
+                send_failure(conn, "since must be a message number")
+                continue
+            joined = enter_room(conn, user, user_name, room_name, since)
+            if joined is not None:
+                user = joined
                 logged_room = chat_rooms[room_name]
+        elif action == "room_history":
+            room_history(conn, user, request)
         elif action == "new_message":
             message = request["message"]
-            if not message:
+            if not message or not isinstance(message, str):
                 send_failure(conn, "You must specify a valid message")
+                continue
+            if "\n" in message:
+                # the room log keeps one message per line
+                send_failure(conn, "Messages cannot contain line breaks")
+                continue
+            room = addressed_room(request, user, logged_room)
+            if room is None:
+                if message == "/upload":
+                    discard_upload(conn)
+                send_failure(conn, "You must be in the chat room to send messages to it")
+                continue
             if message == "/exit":
-                if logged_room is None:
-                    send_failure(conn, "You must be in a chat room to exit")
-                if not user:
-                    send_failure(conn, "You must be logged in to exit")
-                logged_room.remove_client(user)
+                exit_room(conn, room, user)
+                if room is logged_room:
+                    # later requests without a room_name go to another joined room
+                    logged_room = next((chat_rooms[name] for name in user.rooms if name in chat_rooms), None)
             elif message == "/upload":
-                if not room_name:
-                    send_failure(conn, "You must be in a chat room to upload")
-                upload_file(conn, room_name)
+                upload_file(conn, room.name)
             elif message == "/download":
-                if not room_name:
-                    send_failure(conn, "You must be in a chat room to download")
-                download_file(conn, room_name)
+                download_file(conn, room.name)
             else:
-                if not user:
-                    send_failure(conn, "You must be logged in to send messages")
-                if not room_name:
-                    send_failure(conn, "You must be in a chat room to send messages")
-                logged_room.broadcast(message, user)
+                room.broadcast(message, user)
+        elif action == "new_messages":
+            room = addressed_room(request, user, logged_room)
+            if room is None:
+                send_failure(conn, "You must be in the chat room to send messages to it")
+                continue
+            send_messages(conn, room, user, request)
+        elif action == "direct_message":
+            if role is None:
+                send_failure(conn, "You must be logged in to send direct messages")
+                continue
+            direct_message(conn, user_name, request)
         elif action == "change_password":
             password = request["password"]
             change_password(conn, user_name, password)
         else:
             send_failure(conn, "Invalid action")
 
+    slow_request_monitor.finish()
     conn.close()
-    print(f"[CONNECTION CLOSED] {addr} disconnected.")
+    logger.info("connection_closed", addr=addr)
 
 
-def handle_client(conn, addr):
+def handle_client(conn, addr, resumed=None):
     """
     This function handles client connections to the server.
 
     :param conn: The connection object for the client
     :param addr: The address of the client
+    :param resumed: Session state and UserClient of a connection handed over by the previous generation
     :return: None
     """
+    idle_reaper.watch(conn)
     try:
-        internal_handle_client(conn, addr)
+        internal_handle_client(conn, addr, resumed)
+    except socket.timeout:
+        logger.info("login_timeout", addr=addr)
+        metrics.increment("login_timeouts")
+        conn.close()
     except Exception as e:
-        print(f"[ERROR] occurred while handling client connection: {e}")
-        # print traceback
-        traceback.print_exc()
+        logger.error("client_error", addr=addr, error=e, traceback=traceback.format_exc())
+        slow_request_monitor.finish()
         conn.close()
+    finally:
+        # also runs when the handler dies, so no stale presence or room entries are left behind
+        idle_reaper.forget(conn)
+        traffic_capture.closed(conn)
+        disconnect(conn)
+        admission.release(addr[0])
+        handoff.handler_finished()
+
+
+def shed_connection(conn: socket.socket, addr: Tuple[str, int], reason: str) -> None:
+    """Refuse a connection with a "server busy" reply instead of serving it."""
+    logger.warning("connection_shed", addr=addr, reason=reason)
+    metrics.increment("connections_shed_" + reason)
+    try:
+        conn.settimeout(1)
+        send_failure(
+            conn,
+            f"Server busy, retry after {BUSY_RETRY_AFTER} seconds",
+            {"retry_after": BUSY_RETRY_AFTER},
+        )
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def resume_sessions(peer: socket.socket, sessions) -> None:
+    """Serve the connections handed over by the previous server generation."""
+    resumed = []
+    for conn, addr, state in sessions:
+        admission.reserve(addr[0])
+        resumed.append((conn, addr, (state, resume_session(conn, state))))
+    # subscribed last, so nobody is told about the sessions being restored
+    for conn, _, state in sessions:
+        if state["subscribed"]:
+            presence.subscribe(conn)
+    # the previous generation exits on this, only then may the connections be read here
+    handoff.confirm(peer)
+    for conn, addr, session in resumed:
+        handoff.handler_started()
+        threading.Thread(target=handle_client, args=(conn, addr, session)).start()
+    logger.info("sessions_resumed", connections=len(resumed))
 
 
-def start_server():
+def start_server(takeover: bool = False):
     """
     This function starts the server and listens for connections
     to the server.
 
+    :param takeover: Take the listening socket and the clients over from the running server
     :return: None
     """
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(ADDR)
-    server_socket.listen()
-    print(f"[LISTENING] Server is listening on {HOST}")
+    if takeover:
+        peer, server_socket, sessions = handoff.take_over()
+    else:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind(ADDR)
+        server_socket.listen(LISTEN_BACKLOG)
+    logger.info("listening", host=HOST)
     load_chat_rooms_from_groups()
+    retention_settings.load()
+    log_maintenance.start()
+    room_registry.start()
+    idle_reaper.start()
+    if takeover:
+        resume_sessions(peer, sessions)
+    handoff.start(server_socket)
     while True:
-        conn, addr = server_socket.accept()
+        try:
+            wait_for_input(server_socket)
+        except ReadInterrupted:
+            handoff.park_listener()
+            continue
+        sock, addr = server_socket.accept()
+        reason = admission.admit(addr[0])
+        if reason is not None:
+            shed_connection(sock, addr, reason)
+            continue
+        metrics.increment("connections_accepted")
+        enable_keepalive(sock)
+        conn = Connection(sock)
+        # counted before the thread starts, so an upgrade never misses it
+        handoff.handler_started()
         thread = threading.Thread(target=handle_client, args=(conn, addr))
         thread.start()
 
 
 def main():
     DatabaseController()
-    print("[STARTING] Server is starting...")
-    start_server()
+    logger.info("starting")
+    start_server("--takeover" in sys.argv)
 
 
 if __name__ == "__main__":
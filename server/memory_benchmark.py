@@ -0,0 +1,68 @@
+"""
+Measures the server-side memory cost of connected users and of loaded rooms.
+
+Run from the server folder:
+
+    python memory_benchmark.py --users 50000 --rooms 1000
+
+Users are logged in, given a Connection and a UserClient and spread over
+the rooms the way the request handlers do it, but all share one socket
+pair so the count is not limited by file descriptors; kernel socket
+buffers are therefore not included in the numbers.
+"""
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import tracemalloc
+
+
+def measure(users: int, rooms: int) -> None:
+    # rooms keep their logs and indexes relative to the working directory
+    work_dir = tempfile.mkdtemp()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+    try:
+        from chat_room import ChatRoom
+        from connection import Connection
+        from presence import presence
+        from user_client import UserClient
+
+        sock, peer = socket.socketpair()
+        tracemalloc.start()
+
+        before = tracemalloc.get_traced_memory()[0]
+        chat_rooms = [ChatRoom(sys.intern(f"room{i:06d}")) for i in range(rooms)]
+        room_bytes = tracemalloc.get_traced_memory()[0] - before
+
+        before = tracemalloc.get_traced_memory()[0]
+        connections = []
+        for i in range(users):
+            conn = Connection(sock)
+            name = sys.intern(f"user{i:07d}")
+            presence.login(name, conn)
+            client = UserClient(name, conn)
+            room = chat_rooms[i % rooms]
+            room.add_client(client)
+            presence.enter_room(conn, room.name)
+            connections.append(conn)
+        user_bytes = tracemalloc.get_traced_memory()[0] - before
+
+        tracemalloc.stop()
+        print(f"{rooms} rooms: {room_bytes / rooms:.0f} bytes per room")
+        print(f"{users} users: {user_bytes / users:.0f} bytes per connected user")
+        sock.close()
+        peer.close()
+    finally:
+        os.chdir("/")
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    args = parser.parse_args()
+    measure(args.users, args.rooms)
@@ -1,6 +1,7 @@
 
 import json
 import socket
+from connection import PRIORITY_CONTROL, Connection
 from consts import FORMAT
 
 def send_success(conn: socket.socket, data=None) -> None:
@@ -16,9 +17,19 @@ def send_success(conn: socket.socket, data=None) -> None:
     conn.send(json.dumps(message).encode(FORMAT))
 
 
-def send_failure(conn: socket.socket, error_message="") -> None:
+def send_failure(conn: socket.socket, error_message="", data=None) -> None:
     message = {
         "status_code": 400,
         "error_message": error_message,
     }
-    conn.send(json.dumps(message).encode(FORMAT))
\ No newline at end of file
+    if data is not None:
+        message.update(data)
+    conn.send(json.dumps(message).encode(FORMAT))
+
+
+def send_event(conn: Connection, event: str, data=None) -> None:
+    """Push an unsolicited notification (not a reply to a request) to a client, without waiting for it to be written."""
+    message = {"event": event}
+    if data is not None:
+        message.update(data)
+    conn.post(json.dumps(message).encode(FORMAT), PRIORITY_CONTROL)
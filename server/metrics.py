@@ -0,0 +1,36 @@
+import threading
+from typing import Callable, Dict
+
+
+class Metrics:
+    """
+    Process wide counters and gauges. Gauges can also be registered as
+    callbacks that are only evaluated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, int] = {}
+        self._gauges: Dict[str, float] = {}
+        self._gauge_callbacks: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        self._gauges[name] = value
+
+    def register_gauge(self, name: str, callback: Callable[[], float]) -> None:
+        self._gauge_callbacks[name] = callback
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            counters = dict(self._counters)
+        gauges = dict(self._gauges)
+        for name, callback in list(self._gauge_callbacks.items()):
+            gauges[name] = callback()
+        return {"counters": counters, "gauges": gauges}
+
+
+metrics = Metrics()
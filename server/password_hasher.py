@@ -0,0 +1,112 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from consts import (PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_WORKERS,
+                    SCRYPT_N, SCRYPT_P, SCRYPT_R)
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+SCHEME = "scrypt"
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # runs in a worker process
+    return hashlib.scrypt(
+        password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * 1024 * 1024, dklen=32
+    )
+
+
+def _exit_with_parent(parent_pid: int) -> None:
+    # runs in a worker process: workers hold both ends of their task queue, so
+    # they would never notice a server that was killed without shutting them down
+    def watch() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def is_legacy_hash(stored_hash: str) -> bool:
+    """Unsalted SHA-256 hex digests written before scrypt was introduced."""
+    return "$" not in stored_hash
+
+
+class PasswordHasher:
+    """
+    Salted scrypt hashing on a process pool, so key derivation runs on
+    several cores and never holds the GIL of the server process. At most
+    PASSWORD_HASH_MAX_PENDING hashes are queued; further callers wait their
+    turn, which keeps a login storm from queueing unbounded work. Hashes are
+    stored as scrypt$n$r$p$salt$hash (hex) so parameters can be raised later.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self._executor: Optional["ProcessPoolExecutor"] = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._depth = 0
+        self._depth_lock = threading.Lock()
+        metrics.register_gauge("password_hash_queue_depth", lambda: self._depth)
+
+    def _derive(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        with self._depth_lock:
+            self._depth += 1
+        try:
+            with self._slots:
+                return self._get_executor().submit(_scrypt, password, salt, n, r, p).result()
+        finally:
+            with self._depth_lock:
+                self._depth -= 1
+
+    def _get_executor(self) -> "ProcessPoolExecutor":
+        with self._executor_lock:
+            if self._executor is None:
+                # imported on first use, they are a large share of the server's import time
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # fork is unsafe in a process full of threads holding locks
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_exit_with_parent,
+                    initargs=(os.getpid(),),
+                )
+            return self._executor
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        derived = self._derive(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${derived.hex()}"
+
+    def verify(self, password: str, stored_hash: str) -> Tuple[bool, bool]:
+        """Check a password. Returns (matches, should be rehashed with the current parameters)."""
+        if is_legacy_hash(stored_hash):
+            legacy = hashlib.sha256(password.encode()).hexdigest()
+            matches = hmac.compare_digest(legacy, stored_hash)
+            return matches, matches
+        try:
+            scheme, n, r, p, salt, expected = stored_hash.split("$")
+            n, r, p = int(n), int(r), int(p)
+            salt, expected = bytes.fromhex(salt), bytes.fromhex(expected)
+        except ValueError:
+            return False, False
+        if scheme != SCHEME:
+            return False, False
+        matches = hmac.compare_digest(self._derive(password, salt, n, r, p), expected)
+        return matches, matches and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher()
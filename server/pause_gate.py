@@ -0,0 +1,27 @@
+import threading
+
+
+class PauseGate:
+    """
+    Held by a background thread for each pass of its periodic work, so
+    another thread can wait for the pass in progress to end and keep new
+    ones from starting, e.g. while the server hands over to a new
+    generation that runs the same work on the same files.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "PauseGate":
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._lock.release()
+
+    def pause(self, timeout: float = -1) -> bool:
+        """Wait for the pass in progress and hold further ones until resume(). Returns False on timeout."""
+        return self._lock.acquire(timeout=timeout)
+
+    def resume(self) -> None:
+        self._lock.release()
@@ -0,0 +1,147 @@
+import socket
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from logger import logger
+from messages import send_event
+
+
+class PresenceRegistry:
+    """
+    Server wide index of who is online and which rooms they are in.
+    Updated incrementally on login, room entry/exit and disconnect so that
+    queries, and routing messages to a user, never have to walk the chat rooms.
+    A user may be logged in from several connections at once; they go offline
+    when the last one disconnects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # connection -> (username, rooms joined on that connection); tuples
+        # rather than sets as there is one per connection and they are short
+        self._connections: Dict[socket.socket, Tuple[str, Tuple[str, ...]]] = {}
+        # username -> logged-in connections
+        self._by_user: Dict[str, Tuple[socket.socket, ...]] = {}
+        # username -> number of logged-in connections
+        self._online: Dict[str, int] = {}
+        # username -> number of (connection, room) memberships
+        self._in_room: Dict[str, int] = {}
+        self._subscribers: Set[socket.socket] = set()
+
+    def login(self, username: str, conn: socket.socket) -> None:
+        # a connection that logs in again as someone else drops the old identity
+        if conn in self._connections:
+            self.disconnect(conn)
+        with self._lock:
+            self._connections[conn] = (username, ())
+            self._by_user[username] = self._by_user.get(username, ()) + (conn,)
+            came_online = self._increment(self._online, username)
+        if came_online:
+            self._publish({"user": username, "status": "online"})
+
+    def enter_room(self, conn: socket.socket, room_name: str) -> None:
+        with self._lock:
+            entry = self._connections.get(conn)
+            if entry is None or room_name in entry[1]:
+                return
+            username, rooms = entry
+            self._connections[conn] = (username, rooms + (room_name,))
+            self._increment(self._in_room, username)
+        self._publish({"user": username, "status": "joined", "room": room_name})
+
+    def leave_room(self, conn: socket.socket, room_name: str) -> None:
+        with self._lock:
+            entry = self._connections.get(conn)
+            if entry is None or room_name not in entry[1]:
+                return
+            username, rooms = entry
+            self._connections[conn] = (username, tuple(name for name in rooms if name != room_name))
+            self._decrement(self._in_room, username)
+        self._publish({"user": username, "status": "left", "room": room_name})
+
+    def disconnect(self, conn: socket.socket) -> Tuple[Optional[str], Tuple[str, ...]]:
+        """Forget a connection. Returns its username and the rooms it was in."""
+        with self._lock:
+            self._subscribers.discard(conn)
+            entry = self._connections.pop(conn, None)
+            if entry is None:
+                return None, ()
+            username, rooms = entry
+            user_connections = tuple(c for c in self._by_user.get(username, ()) if c is not conn)
+            if user_connections:
+                self._by_user[username] = user_connections
+            else:
+                self._by_user.pop(username, None)
+            for _ in rooms:
+                self._decrement(self._in_room, username)
+            went_offline = self._decrement(self._online, username)
+        for room_name in rooms:
+            self._publish({"user": username, "status": "left", "room": room_name})
+        if went_offline:
+            self._publish({"user": username, "status": "offline"})
+        return username, rooms
+
+    def username(self, conn: socket.socket) -> Optional[str]:
+        entry = self._connections.get(conn)
+        return entry[0] if entry is not None else None
+
+    def connections_of(self, username: str) -> List[socket.socket]:
+        """The connections a user is logged in on (empty when offline)."""
+        with self._lock:
+            return list(self._by_user.get(username, ()))
+
+    def online_users(self) -> List[str]:
+        with self._lock:
+            return list(self._online)
+
+    def users_in_rooms(self) -> List[str]:
+        with self._lock:
+            return list(self._in_room)
+
+    def online_count(self) -> int:
+        return len(self._online)
+
+    def in_room_count(self) -> int:
+        return len(self._in_room)
+
+    def subscribe(self, conn: socket.socket) -> None:
+        with self._lock:
+            self._subscribers.add(conn)
+
+    def is_subscribed(self, conn: socket.socket) -> bool:
+        return conn in self._subscribers
+
+    def unsubscribe(self, conn: socket.socket) -> None:
+        with self._lock:
+            self._subscribers.discard(conn)
+
+    def _publish(self, data) -> None:
+        if not self._subscribers:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for conn in subscribers:
+            try:
+                send_event(conn, "presence", data)
+            except Exception as e:
+                logger.warning("presence_publish_failed", error=e)
+                self.unsubscribe(conn)
+
+    @staticmethod
+    def _increment(counts: Dict[str, int], username: str) -> bool:
+        """Returns True when the user was not counted before."""
+        counts[username] = counts.get(username, 0) + 1
+        return counts[username] == 1
+
+    @staticmethod
+    def _decrement(counts: Dict[str, int], username: str) -> bool:
+        """Returns True when the user is no longer counted."""
+        count = counts.get(username, 0) - 1
+        if count > 0:
+            counts[username] = count
+            return False
+        counts.pop(username, None)
+        return True
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Dict, List, Optional
+
+from logger import logger
+
+
+def collapse_stack(frame) -> str:
+    """Collapse a frame chain into a flamegraph line (root first, ';' separated)."""
+    names: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Low overhead wall-clock profiler. Periodically samples the stacks of all
+    threads and writes the counts in collapsed-stack format, which can be fed
+    directly to flamegraph.pl or speedscope.
+    """
+
+    output_folder = "profiles"
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float) -> str:
+        """Start sampling for `duration` seconds and return the output file path."""
+        with self._lock:
+            if self.is_running():
+                raise RuntimeError("Profiler is already running")
+            if not os.path.exists(self.output_folder):
+                os.mkdir(self.output_folder)
+            file_path = os.path.join(
+                self.output_folder, time.strftime("profile_%Y%m%d_%H%M%S.folded")
+            )
+            self._thread = threading.Thread(
+                target=self._run, args=(duration, file_path), daemon=True
+            )
+            self._thread.start()
+            return file_path
+
+    def _run(self, duration: float, file_path: str) -> None:
+        samples: Counter = Counter()
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    samples[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+
+        with open(file_path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info("profiler_finished", samples=sum(samples.values()), file_path=file_path)
+
+
+class SlowRequestMonitor:
+    """
+    Watches in-flight requests and logs the stack of every request that runs
+    longer than `threshold` seconds, while it is still running.
+    Disabled while the threshold is None.
+    """
+
+    log_file = "logs/slow_requests.log"
+
+    def __init__(self):
+        self.threshold: Optional[float] = None
+        # thread id -> [action, start time, already reported]
+        self._in_flight: Dict[int, list] = {}
+        self._watcher: Optional[threading.Thread] = None
+
+    def set_threshold(self, threshold: Optional[float]) -> None:
+        self.threshold = threshold
+        if threshold is not None and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def start(self, action: str) -> None:
+        """Mark the calling handler thread as busy with `action`."""
+        if self.threshold is None:
+            return
+        self._in_flight[threading.get_ident()] = [action, time.monotonic(), False]
+
+    def finish(self) -> None:
+        """Mark the calling handler thread's current request (if any) as done."""
+        entry = self._in_flight.pop(threading.get_ident(), None)
+        if entry is not None and entry[2]:
+            action, started, _ = entry
+            self._write(
+                f"[SLOW REQUEST] {action} completed after {time.monotonic() - started:.3f}s\n"
+            )
+
+    def _watch(self) -> None:
+        while True:
+            threshold = self.threshold
+            if threshold is None:
+                time.sleep(0.5)
+                continue
+            now = time.monotonic()
+            frames = None
+            for thread_id, entry in list(self._in_flight.items()):
+                action, started, reported = entry
+                if reported or now - started < threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                entry[2] = True
+                stack = "".join(traceback.format_stack(frame))
+                self._write(
+                    f"[SLOW REQUEST] {action} running for {now - started:.3f}s "
+                    f"(thread {thread_id}):\n{stack}"
+                )
+            time.sleep(max(threshold / 4, 0.01))
+
+    def _write(self, text: str) -> None:
+        with open(self.log_file, "a", encoding="utf-8") as f:
+            f.write(text)
+
+
+profiler = SamplingProfiler()
+slow_request_monitor = SlowRequestMonitor()
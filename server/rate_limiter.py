@@ -0,0 +1,111 @@
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from consts import (RATE_LIMIT_ACTION_COSTS, RATE_LIMIT_BATCH_BUCKET,
+                    RATE_LIMIT_IP_BUCKET, RATE_LIMIT_USER_BUCKET)
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "refill_rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, refill_rate: float, now: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """Seconds until `cost` tokens are available (0 when they already are)."""
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.refill_rate
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiting shared by every connection. Each request
+    costs tokens (RATE_LIMIT_ACTION_COSTS) from the bucket of the user
+    (once logged in) and of the remote IP, so limits survive reconnecting,
+    re-entering rooms and switching accounts. The messages of a
+    new_messages batch are also charged to a batch bucket of the user (or
+    IP), sized for relays rather than for typing. Checks are O(1); buckets
+    that have refilled completely are swept periodically.
+    """
+
+    sweep_every = 10000
+
+    def __init__(
+        self,
+        user_bucket: Tuple[float, float] = RATE_LIMIT_USER_BUCKET,
+        ip_bucket: Tuple[float, float] = RATE_LIMIT_IP_BUCKET,
+        action_costs: Optional[Dict[str, float]] = None,
+        batch_bucket: Tuple[float, float] = RATE_LIMIT_BATCH_BUCKET,
+    ):
+        self.user_bucket = user_bucket
+        self.ip_bucket = ip_bucket
+        self.batch_bucket = batch_bucket
+        self.action_costs = RATE_LIMIT_ACTION_COSTS if action_costs is None else action_costs
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._checks = 0
+        self._lock = threading.Lock()
+
+    def cost(self, request: Dict[str, Any]) -> float:
+        """Cost of a request; chat commands such as /upload are priced on their own."""
+        action = request.get("action")
+        if action == "new_message" and request.get("message") in self.action_costs:
+            return self.action_costs[request["message"]]
+        return self.action_costs.get(action, 1)
+
+    @staticmethod
+    def batch_cost(request: Dict[str, Any]) -> int:
+        """Messages a request takes from the batch bucket."""
+        if request.get("action") == "new_messages" and isinstance(request.get("messages"), list):
+            return len(request["messages"])
+        return 0
+
+    def check(self, request: Dict[str, Any], user_name: Optional[str], ip: str) -> float:
+        """Charge a request. Returns 0 when allowed, otherwise the seconds to wait before retrying."""
+        cost = self.cost(request)
+        batch_cost = self.batch_cost(request)
+        if cost <= 0 and batch_cost <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            charges = [(self._bucket("ip", ip, self.ip_bucket, now), cost)]
+            if user_name is not None:
+                charges.append((self._bucket("user", user_name, self.user_bucket, now), cost))
+            if batch_cost > 0:
+                scope, key = ("batch", user_name) if user_name is not None else ("batch_ip", ip)
+                charges.append((self._bucket(scope, key, self.batch_bucket, now), batch_cost))
+            retry_after = 0.0
+            for bucket, charge in charges:
+                bucket.refill(now)
+                retry_after = max(retry_after, bucket.wait_time(charge))
+            if retry_after == 0:
+                for bucket, charge in charges:
+                    bucket.tokens -= charge
+            self._checks += 1
+            if self._checks % self.sweep_every == 0:
+                self._sweep(now)
+            return retry_after
+
+    def _bucket(self, scope: str, key: str, config: Tuple[float, float], now: float) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            bucket = self._buckets[(scope, key)] = TokenBucket(config[0], config[1], now)
+        return bucket
+
+    def _sweep(self, now: float) -> None:
+        """Drop buckets that are full again; they are recreated full on demand."""
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,465 @@
+import bisect
+import csv
+import gzip
+import itertools
+import os
+import secrets
+import shutil
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from consts import (LOG_MAINTENANCE_INTERVAL, ROOM_LOG_RETENTION_BYTES,
+                    ROOM_LOG_RETENTION_DAYS, ROOM_LOG_SEGMENT_BYTES,
+                    ROOM_LOG_SEGMENT_SECONDS)
+from logger import logger
+from pause_gate import PauseGate
+
+# locations read_lines sorts and reads at a time
+READ_BATCH = 256
+
+# every RoomLog that is currently open, for the background maintenance thread
+open_logs: "weakref.WeakSet[RoomLog]" = weakref.WeakSet()
+
+
+class Segment:
+    """
+    One file of a room log. Messages are numbered per room; a segment is named
+    after the number of its first message and its creation time, e.g.
+    000000000042_1700000000.log, and gets a .gz suffix once compressed.
+    """
+
+    __slots__ = ("folder", "first_number", "created", "compressed")
+
+    def __init__(self, folder: str, first_number: int, created: int, compressed: bool = False):
+        self.folder = folder
+        self.first_number = first_number
+        self.created = created
+        self.compressed = compressed
+
+    @property
+    def path(self) -> str:
+        name = f"{self.first_number:012d}_{self.created}.log"
+        return os.path.join(self.folder, name + ".gz" if self.compressed else name)
+
+    @staticmethod
+    def parse(folder: str, file_name: str) -> Optional["Segment"]:
+        compressed = file_name.endswith(".log.gz")
+        if not compressed and not file_name.endswith(".log"):
+            return None
+        stem = file_name[: -len(".log.gz")] if compressed else file_name[: -len(".log")]
+        first, _, created = stem.partition("_")
+        if not first.isdigit() or not created.isdigit():
+            return None
+        return Segment(folder, int(first), int(created), compressed)
+
+    def open(self):
+        return gzip.open(self.path, "rb") if self.compressed else open(self.path, "rb")
+
+
+class RoomLog:
+    """
+    Segmented, append-only message log of a chat room.
+    The newest (live) segment is rolled over once it exceeds
+    ROOM_LOG_SEGMENT_BYTES or ROOM_LOG_SEGMENT_SECONDS. Older segments are
+    gzip compressed and expired by the background maintenance thread, and all
+    reads transparently span compressed and live segments.
+    """
+
+    logs_folder = "logs"
+
+    __slots__ = (
+        "room_name", "lock", "maintenance_lock", "on_retention", "segments",
+        "next_number", "_live_size", "_loaded", "_incarnation", "__weakref__",
+    )
+
+    def __init__(self, room_name: str):
+        self.room_name = room_name
+        self.lock = threading.Lock()
+        # one maintenance pass at a time, whichever thread runs it
+        self.maintenance_lock = threading.Lock()
+        # called with the first retained message number after old segments are expired
+        self.on_retention: Optional[Callable[[int], None]] = None
+        self.segments: List[Segment] = []
+        self.next_number = 0
+        self._live_size = 0
+        self._loaded = False
+        self._incarnation: Optional[str] = None
+        open_logs.add(self)
+
+    @property
+    def folder(self) -> str:
+        return os.path.join(self.logs_folder, "chat_room_" + self.room_name)
+
+    def _load(self) -> None:
+        """Discover the segments on disk. Caller holds the lock."""
+        if self._loaded:
+            return
+        self._loaded = True
+        legacy_file = self.folder + ".log"
+        if os.path.isfile(legacy_file) and not os.path.isdir(self.folder):
+            # single file log from before segmentation becomes the first segment
+            os.mkdir(self.folder)
+            segment = Segment(self.folder, 0, int(os.path.getmtime(legacy_file)))
+            os.replace(legacy_file, segment.path)
+        if not os.path.isdir(self.folder):
+            return
+        segments = [Segment.parse(self.folder, name) for name in os.listdir(self.folder)]
+        self.segments = sorted(
+            (segment for segment in segments if segment is not None),
+            key=lambda segment: segment.first_number,
+        )
+        if not self.segments:
+            return
+        live = self.segments[-1]
+        count = 0
+        with live.open() as f:
+            for line in f:
+                count += 1
+                self._live_size += len(line)
+        self.next_number = live.first_number + count
+
+    def append(self, line: str) -> Tuple[int, int]:
+        """Append a line ending in a newline. Returns its message number and offset in its segment."""
+        return self.append_many([line])[0]
+
+    def append_many(self, lines: List[str]) -> List[Tuple[int, int]]:
+        """Append several lines with a single write. Returns the number and offset of each."""
+        encoded = [line.encode("utf-8") for line in lines]
+        with self.lock:
+            self._load()
+            live = self._live_segment()
+            locations = []
+            offset = self._live_size
+            for data in encoded:
+                locations.append((self.next_number, offset))
+                self.next_number += 1
+                offset += len(data)
+            with open(live.path, "ab") as f:
+                f.write(b"".join(encoded))
+            self._live_size = offset
+            return locations
+
+    def _live_segment(self) -> Segment:
+        """Return the segment to append to, rolling over when needed. Caller holds the lock."""
+        now = int(time.time())
+        if self.segments:
+            live = self.segments[-1]
+            if (
+                not live.compressed
+                and self._live_size < ROOM_LOG_SEGMENT_BYTES
+                and now - live.created < ROOM_LOG_SEGMENT_SECONDS
+            ):
+                return live
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        live = Segment(self.folder, self.next_number, now)
+        self.segments.append(live)
+        self._live_size = 0
+        return live
+
+    def _snapshot(self) -> List[Segment]:
+        with self.lock:
+            self._load()
+            return list(self.segments)
+
+    def first_number(self) -> int:
+        segments = self._snapshot()
+        return segments[0].first_number if segments else self.next_number
+
+    def incarnation(self) -> str:
+        """
+        Id of this log, kept in its folder. A room that is deleted and created
+        again gets a new one, so clients caching its history know to start over.
+        """
+        with self.lock:
+            self._load()
+            if self._incarnation is None:
+                path = os.path.join(self.folder, "incarnation")
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        self._incarnation = f.read().strip() or None
+                except FileNotFoundError:
+                    pass
+                if self._incarnation is None:
+                    os.makedirs(self.folder, exist_ok=True)
+                    incarnation = secrets.token_hex(8)
+                    with open(path + ".tmp", "w", encoding="utf-8") as f:
+                        f.write(incarnation)
+                    os.replace(path + ".tmp", path)
+                    self._incarnation = incarnation
+            return self._incarnation
+
+    @classmethod
+    def summary(cls, room_name: str) -> Tuple[int, Optional[float]]:
+        """
+        Message count and last activity of a room's log, read from its folder
+        without opening the log: segment names give the numbering, and only
+        the live segment is read, to count its messages.
+        """
+        folder = os.path.join(cls.logs_folder, "chat_room_" + room_name)
+        legacy_file = folder + ".log"
+        if os.path.isfile(legacy_file) and not os.path.isdir(folder):
+            first_number, live_first_number, live_path, opener = 0, 0, legacy_file, open
+        else:
+            try:
+                names = os.listdir(folder)
+            except FileNotFoundError:
+                return 0, None
+            segments = [segment for segment in (Segment.parse(folder, name) for name in names) if segment]
+            if not segments:
+                return 0, None
+            first_number = min(segment.first_number for segment in segments)
+            live = max(segments, key=lambda segment: segment.first_number)
+            live_first_number, live_path = live.first_number, live.path
+            opener = gzip.open if live.compressed else open
+        count = 0
+        try:
+            with opener(live_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    count += block.count(b"\n")
+            last_activity = os.path.getmtime(live_path)
+        except OSError:
+            return 0, None
+        return live_first_number + count - first_number, last_activity
+
+    def end_number(self) -> int:
+        """The number the next appended message will get."""
+        with self.lock:
+            self._load()
+            return self.next_number
+
+    def message_count(self) -> int:
+        return self.end_number() - self.first_number()
+
+    def last_activity(self) -> Optional[float]:
+        segments = self._snapshot()
+        if not segments:
+            return None
+        try:
+            return os.path.getmtime(segments[-1].path)
+        except OSError:
+            return None
+
+    def iter_messages(self, start: int = 0) -> Iterator[Tuple[int, int, str]]:
+        """Yield (number, offset in segment, line) for every retained message numbered >= start."""
+        segments = self._snapshot()
+        first = max(bisect.bisect_right([s.first_number for s in segments], start) - 1, 0)
+        for segment in segments[first:]:
+            number = segment.first_number
+            offset = 0
+            try:
+                f = segment.open()
+            except FileNotFoundError:
+                # compressed or expired while we were reading
+                segment = self._find_segment(segment.first_number)
+                if segment is None:
+                    continue
+                f = segment.open()
+            with f:
+                for raw_line in f:
+                    if not raw_line.endswith(b"\n"):
+                        # a write in progress
+                        break
+                    if number >= start:
+                        yield number, offset, raw_line.decode("utf-8", errors="replace")
+                    number += 1
+                    offset += len(raw_line)
+
+    def read_lines(self, locations: Iterable[Tuple[int, int]]) -> Iterator[Tuple[int, Optional[str]]]:
+        """
+        Read the messages at the given (number, offset) locations, in the order
+        given; expired messages read as None. Locations are read in batches
+        sorted by position, as seeking backwards in a compressed segment
+        decompresses it again from its start.
+        """
+        open_files: Dict[int, object] = {}
+        locations = iter(locations)
+        try:
+            while True:
+                batch = list(itertools.islice(locations, READ_BATCH))
+                if not batch:
+                    return
+                lines = {}
+                for number, offset in sorted(batch):
+                    lines[number] = self._read_line(open_files, number, offset)
+                for number, _ in batch:
+                    yield number, lines[number]
+        finally:
+            for f in open_files.values():
+                f.close()
+
+    def _read_line(self, open_files: Dict[int, object], number: int, offset: int) -> Optional[str]:
+        segment = self._find_segment(number)
+        if segment is None:
+            return None
+        f = open_files.get(segment.first_number)
+        if f is None:
+            try:
+                f = segment.open()
+            except FileNotFoundError:
+                segment = self._find_segment(number)
+                if segment is None:
+                    return None
+                f = segment.open()
+            open_files[segment.first_number] = f
+        f.seek(offset)
+        return f.readline().decode("utf-8", errors="replace")
+
+    def _find_segment(self, number: int) -> Optional[Segment]:
+        segments = self._snapshot()
+        index = bisect.bisect_right([s.first_number for s in segments], number) - 1
+        if index < 0 or number >= self.next_number:
+            return None
+        return segments[index]
+
+    def maintain(self) -> None:
+        """Compress cold segments and expire old ones per the room's retention settings."""
+        with self.maintenance_lock:
+            self.compress_cold_segments()
+            self.apply_retention(*retention_settings.get(self.room_name))
+
+    def compress_cold_segments(self) -> None:
+        """Gzip every segment but the live one."""
+        for segment in self._snapshot()[:-1]:
+            if segment.compressed:
+                continue
+            compressed = Segment(segment.folder, segment.first_number, segment.created, True)
+            temp_path = compressed.path + ".tmp"
+            with open(segment.path, "rb") as source, gzip.open(temp_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.replace(temp_path, compressed.path)
+            with self.lock:
+                replaced = segment in self.segments
+                if replaced:
+                    self.segments[self.segments.index(segment)] = compressed
+            if not replaced:
+                # the room was deleted, or the segment expired, while it was being compressed
+                try:
+                    os.remove(compressed.path)
+                except OSError:
+                    pass
+                continue
+            os.remove(segment.path)
+            logger.info("room_log_segment_compressed", room=self.room_name, segment=compressed.path)
+
+    def apply_retention(self, max_age_days: Optional[float], max_bytes: Optional[int]) -> None:
+        """Delete the oldest segments (never the live one) beyond the age or size limit."""
+        segments = self._snapshot()
+        if len(segments) < 2:
+            return
+        now = time.time()
+        sizes = [os.path.getsize(segment.path) for segment in segments]
+        total = sum(sizes)
+        expired = 0
+        for segment, size in zip(segments[:-1], sizes):
+            too_old = max_age_days is not None and now - segment.created > max_age_days * 86400
+            too_big = max_bytes is not None and total > max_bytes
+            if not too_old and not too_big:
+                break
+            total -= size
+            expired += 1
+        if not expired:
+            return
+        with self.lock:
+            del self.segments[:expired]
+            first_retained = self.segments[0].first_number
+        for segment in segments[:expired]:
+            os.remove(segment.path)
+        logger.info("room_log_expired", room=self.room_name, segments=expired)
+        if self.on_retention is not None:
+            self.on_retention(first_retained)
+
+    def destroy(self) -> None:
+        """Delete the whole log (used when the room is deleted)."""
+        with self.lock:
+            self.segments = []
+            self.next_number = 0
+            self._live_size = 0
+            self._incarnation = None
+            open_logs.discard(self)
+            if os.path.isdir(self.folder):
+                shutil.rmtree(self.folder)
+            if os.path.isfile(self.folder + ".log"):
+                os.remove(self.folder + ".log")
+
+
+class RetentionSettings:
+    """Per-room retention overrides, persisted in database/retention.csv."""
+
+    settings_file = "database/retention.csv"
+
+    def __init__(self):
+        self._settings: Dict[str, Tuple[Optional[float], Optional[int]]] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        if not os.path.isfile(self.settings_file):
+            return
+        with open(self.settings_file, "r", newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for room_name, max_age_days, max_bytes in reader:
+                self._settings[room_name] = (
+                    float(max_age_days) if max_age_days else None,
+                    int(max_bytes) if max_bytes else None,
+                )
+
+    def get(self, room_name: str) -> Tuple[Optional[float], Optional[int]]:
+        return self._settings.get(room_name, (ROOM_LOG_RETENTION_DAYS, ROOM_LOG_RETENTION_BYTES))
+
+    def set(self, room_name: str, max_age_days: Optional[float], max_bytes: Optional[int]) -> None:
+        with self._lock:
+            self._settings[room_name] = (max_age_days, max_bytes)
+            self._save()
+
+    def remove(self, room_name: str) -> None:
+        with self._lock:
+            if self._settings.pop(room_name, None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        with open(self.settings_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["room_name", "max_age_days", "max_bytes"])
+            for room_name, (max_age_days, max_bytes) in self._settings.items():
+                writer.writerow([
+                    room_name,
+                    "" if max_age_days is None else max_age_days,
+                    "" if max_bytes is None else max_bytes,
+                ])
+
+
+class LogMaintenance:
+    """Background thread that compresses cold segments and enforces retention."""
+
+    def __init__(self, interval: float = LOG_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self.gate = PauseGate()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def run_once(self) -> None:
+        for room_log in list(open_logs):
+            try:
+                room_log.maintain()
+            except OSError as e:
+                logger.warning("room_log_maintenance_failed", room=room_log.room_name, error=e)
+            except Exception as e:
+                # one broken log must not stop the maintenance of all the others
+                logger.error("room_log_maintenance_failed", room=room_log.room_name, error=e)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.gate:
+                self.run_once()
+
+
+retention_settings = RetentionSettings()
+log_maintenance = LogMaintenance()
@@ -0,0 +1,271 @@
+import bisect
+import csv
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from chat_room import ChatRoom
+from consts import ROOM_EVICT_INTERVAL, ROOM_IDLE_SECONDS
+from logger import logger
+from metrics import metrics
+from pause_gate import PauseGate
+from room_log import open_logs
+from search_index import index_saver
+
+
+class RoomRegistry:
+    """
+    The in-memory source of truth for chat rooms.
+    groups.csv is only read on startup; changes are appended to a journal
+    (one "+name" / "-name" row per change) which is folded back into
+    groups.csv on the next startup or once it grows past `compact_after` rows.
+    Room names are also kept sorted so listings with a prefix filter and
+    paging cost O(log n + rooms returned).
+    Startup only reads the names. A ChatRoom (its lock, log and search index)
+    is built on first access, and rooms nobody is in are returned to this
+    dormant state after ROOM_IDLE_SECONDS without being accessed, once their
+    log has had its maintenance pass.
+    """
+
+    groups_file = "database/groups.csv"
+    journal_file = "database/groups.journal"
+    compact_after = 1000
+
+    def __init__(self, idle_seconds: float = ROOM_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._names: Set[str] = set()
+        self._sorted_names: List[str] = []
+        # materialized rooms and when each was last accessed
+        self._active: Dict[str, ChatRoom] = {}
+        self._last_used: Dict[str, float] = {}
+        # set once the room being materialized under a name is active
+        self._loading: Dict[str, threading.Event] = {}
+        # listing metadata of dormant rooms, from when they were evicted or first listed
+        self._dormant_metadata: Dict[str, Dict[str, Any]] = {}
+        self._journal_entries = 0
+        self._lock = threading.Lock()
+        # held while evicting
+        self.gate = PauseGate()
+        self._thread: Optional[threading.Thread] = None
+        metrics.register_gauge("rooms_active", lambda: len(self._active))
+
+    def load(self) -> None:
+        names = []
+        if os.path.isfile(self.groups_file):
+            with open(self.groups_file, "r", newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                names = [row[0] for row in reader if row]
+        loaded = dict.fromkeys(names)
+        journaled = os.path.isfile(self.journal_file)
+        if journaled:
+            with open(self.journal_file, "r", newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if len(row) != 2:
+                        continue
+                    operation, name = row
+                    if operation == "+":
+                        loaded[name] = None
+                    elif operation == "-":
+                        loaded.pop(name, None)
+        with self._lock:
+            self._names = set(loaded)
+            # groups.csv is written sorted, which makes this a linear pass
+            self._sorted_names = sorted(loaded)
+            if journaled:
+                self._compact()
+        logger.info("rooms_loaded", count=len(self._names))
+
+    def start(self) -> None:
+        """Start evicting idle rooms in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __getitem__(self, name: str) -> ChatRoom:
+        room = self.get(name)
+        if room is None:
+            raise KeyError(name)
+        return room
+
+    def get(self, name: str) -> Optional[ChatRoom]:
+        """The room called `name`, materialized if it was dormant; None when there is no such room."""
+        while True:
+            # looked up and touched together, or evict_idle could drop the room in between
+            with self._lock:
+                room = self._active.get(name)
+                if room is not None:
+                    self._last_used[name] = time.monotonic()
+                    return room
+                if name not in self._names:
+                    return None
+                loading = self._loading.get(name)
+                if loading is None:
+                    loading = self._loading[name] = threading.Event()
+                    break
+            # another thread is materializing the room; use what it built
+            loading.wait()
+        return self._materialize(name, loading)
+
+    def _materialize(self, name: str, loading: threading.Event) -> Optional[ChatRoom]:
+        """
+        Build a room object and catch its search index up with its log, which
+        takes long for a long log, so without holding the lock; other lookups
+        of the room wait on `loading`. Returns None when the room was deleted
+        meanwhile.
+        """
+        room = None
+        try:
+            room = ChatRoom(name)
+            room.search_index.load()
+        finally:
+            with self._lock:
+                # delete() drops the entry, so a room created again under the name gets its own
+                current = self._loading.get(name) is loading
+                if current:
+                    del self._loading[name]
+                if room is not None and current:
+                    self._active[name] = room
+                    self._last_used[name] = time.monotonic()
+                    self._dormant_metadata.pop(name, None)
+                elif room is not None:
+                    open_logs.discard(room.log)
+                    room = None
+            loading.set()
+        return room
+
+    def create(self, name: str) -> Optional[ChatRoom]:
+        """Create and persist a room. Returns None when it already exists (or was deleted again at once)."""
+        with self._lock:
+            if name in self._names:
+                return None
+            self._names.add(name)
+            bisect.insort(self._sorted_names, name)
+            # journaled after the change, a compaction writes groups.csv from the names
+            self._append_journal("+", name)
+            loading = self._loading[name] = threading.Event()
+        return self._materialize(name, loading)
+
+    def delete(self, name: str) -> Optional[ChatRoom]:
+        """Delete a room. Returns the removed room, or None when it does not exist."""
+        with self._lock:
+            if name not in self._names:
+                return None
+            room = self._active.pop(name, None)
+            self._last_used.pop(name, None)
+            self._loading.pop(name, None)
+            self._dormant_metadata.pop(name, None)
+            self._names.discard(name)
+            index = bisect.bisect_left(self._sorted_names, name)
+            del self._sorted_names[index]
+            self._append_journal("-", name)
+        if room is None:
+            # a dormant room; only its log and index are left to remove
+            room = ChatRoom(name)
+            open_logs.discard(room.log)
+        return room
+
+    def list(
+        self, prefix: str = "", offset: int = 0, limit: Optional[int] = None
+    ) -> Tuple[List[str], int]:
+        """Return one page of room names starting with `prefix`, and the total match count."""
+        with self._lock:
+            names = self._sorted_names
+            low = bisect.bisect_left(names, prefix)
+            if prefix:
+                high = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            else:
+                high = len(names)
+            start = min(low + max(offset, 0), high)
+            end = high if limit is None else min(start + max(limit, 0), high)
+            return names[start:end], high - low
+
+    def metadata(self, names: List[str]) -> List[Dict[str, Any]]:
+        """
+        Listing metadata of the named rooms, skipping those deleted meanwhile.
+        Dormant rooms are not materialized for it; their metadata is read
+        from disk once and kept until they are materialized again.
+        """
+        details = []
+        for name in names:
+            with self._lock:
+                if name not in self._names:
+                    continue
+                room = self._active.get(name)
+                data = self._dormant_metadata.get(name)
+            if room is not None:
+                data = room.get_metadata()
+            elif data is None:
+                data = ChatRoom.dormant_metadata(name)
+                with self._lock:
+                    if name not in self._names:
+                        continue
+                    if name not in self._active:
+                        self._dormant_metadata[name] = data
+            details.append(data)
+        return details
+
+    def evict_idle(self) -> None:
+        """Return rooms that nobody is in and that were not accessed lately to the dormant state."""
+        deadline = time.monotonic() - self.idle_seconds
+        idle = [
+            room for name, room in list(self._active.items())
+            if not room.clients and self._last_used.get(name, 0) < deadline
+        ]
+        for room in idle:
+            # dormant logs are not seen by the maintenance thread, so maintain them now
+            try:
+                room.log.maintain()
+            except OSError as e:
+                logger.warning("room_log_maintenance_failed", room=room.name, error=e)
+            index_saver.flush(room.search_index)
+            metadata = room.get_metadata()
+            with self._lock:
+                if room.clients or self._last_used.get(room.name, 0) >= deadline:
+                    continue
+                if self._active.get(room.name) is room:
+                    del self._active[room.name]
+                    del self._last_used[room.name]
+                    self._dormant_metadata[room.name] = metadata
+                    # the log keeps itself alive through its index, so drop it explicitly
+                    open_logs.discard(room.log)
+        if idle:
+            logger.info("rooms_evicted", count=len(idle), active=len(self._active))
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(ROOM_EVICT_INTERVAL)
+            try:
+                with self.gate:
+                    self.evict_idle()
+            except Exception as e:
+                logger.error("room_eviction_failed", error=e)
+
+    def _append_journal(self, operation: str, name: str) -> None:
+        with open(self.journal_file, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow([operation, name])
+        self._journal_entries += 1
+        if self._journal_entries >= self.compact_after:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Rewrite groups.csv from memory and truncate the journal. Caller holds the lock."""
+        temp_file = self.groups_file + ".tmp"
+        with open(temp_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["group_name"])
+            writer.writerows([name] for name in self._sorted_names)
+        os.replace(temp_file, self.groups_file)
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        self._journal_entries = 0
+
+
+room_registry = RoomRegistry()
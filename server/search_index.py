@@ -0,0 +1,275 @@
+import atexit
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from logger import logger
+from pause_gate import PauseGate
+from room_log import RoomLog
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# prefix of the pseudo term under which each message's sender is indexed ('@' is never part of a token)
+SENDER_PREFIX = "@"
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query: str) -> Tuple[List[str], List[List[str]]]:
+    """Split a query into loose terms and "quoted phrases" (each a list of terms)."""
+    phrases = [tokenize(phrase) for phrase in re.findall(r'"([^"]*)"', query)]
+    terms = tokenize(re.sub(r'"[^"]*"', " ", query))
+    return terms, [phrase for phrase in phrases if phrase]
+
+
+def _delta_encode(values: Iterable[int]) -> List[int]:
+    encoded, previous = [], 0
+    for value in values:
+        encoded.append(value - previous)
+        previous = value
+    return encoded
+
+
+def _delta_decode(values: Iterable[int], typecode: str) -> array:
+    decoded, total = array(typecode), 0
+    for value in values:
+        total += value
+        decoded.append(total)
+    return decoded
+
+
+class RoomIndex:
+    """
+    Inverted index over a single room log. Maps every term (and the sender,
+    as "@name") to the ascending list of message numbers containing it, and
+    keeps the offset of every message within its log segment so hits can be
+    read back. Persisted as delta encoded, zlib compressed JSON together with
+    the numbers it covers, so loading only needs to tokenize newer messages.
+    """
+
+    index_folder = "index"
+    version = 2
+
+    __slots__ = ("room_name", "room_log", "postings", "base", "offsets", "lock")
+
+    def __init__(self, room_name: str, room_log: RoomLog):
+        self.room_name = room_name
+        self.room_log = room_log
+        self.postings: Dict[str, array] = {}
+        # offsets[i] is the offset of message number base + i
+        self.base = 0
+        self.offsets = array("Q")
+        self.lock = threading.Lock()
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.index_folder, self.room_name + ".idx")
+
+    @property
+    def next_number(self) -> int:
+        return self.base + len(self.offsets)
+
+    def load(self) -> None:
+        """Load the persisted index and index whatever was logged after it was saved."""
+        with self.lock:
+            self._read_index_file()
+            if self.room_log.end_number() < self.next_number:
+                # log was replaced underneath us, start over
+                self._reset()
+            caught_up = 0
+            for number, offset, line in self.room_log.iter_messages(self.next_number):
+                self._add(number, offset, line)
+                caught_up += 1
+        if caught_up:
+            logger.info("search_index_caught_up", room=self.room_name, messages=caught_up)
+            index_saver.mark_dirty(self)
+
+    def add(self, number: int, offset: int, line: str) -> None:
+        """Index a message that was just appended to the log."""
+        with self.lock:
+            self._add(number, offset, line)
+        index_saver.mark_dirty(self)
+
+    def _add(self, number: int, offset: int, line: str) -> None:
+        if not self.offsets:
+            self.base = number
+        if number < self.next_number:
+            return
+        while self.next_number < number:
+            # a gap in the log, nothing to index
+            self.offsets.append(0)
+        self.offsets.append(offset)
+        sender, _, message = line.rstrip("\n").partition(":")
+        terms: Set[str] = set(tokenize(message))
+        terms.add(SENDER_PREFIX + sender)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array("I")
+            postings.append(number)
+
+    def prune(self, first_number: int) -> None:
+        """Forget messages numbered below `first_number`, which were expired from the log."""
+        with self.lock:
+            if first_number <= self.base:
+                return
+            del self.offsets[: first_number - self.base]
+            self.base = first_number
+            for term in list(self.postings):
+                postings = self.postings[term]
+                del postings[: bisect.bisect_left(postings, first_number)]
+                if not postings:
+                    del self.postings[term]
+        index_saver.mark_dirty(self)
+
+    def _reset(self) -> None:
+        self.postings, self.base, self.offsets = {}, 0, array("Q")
+
+    def search(
+        self, query: str, sender: Optional[str] = None, offset: int = 0, limit: int = 20
+    ) -> Tuple[List[Dict], bool]:
+        """Return one page of matches (newest first) and whether more matches exist."""
+        terms, phrases = parse_query(query)
+        required = set(terms)
+        for phrase in phrases:
+            required.update(phrase)
+        if sender:
+            required.add(SENDER_PREFIX + sender)
+        if not required:
+            return [], False
+
+        with self.lock:
+            lists = [self.postings.get(term) for term in required]
+            if any(postings is None for postings in lists):
+                return [], False
+            lists.sort(key=len)
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                candidates.intersection_update(postings)
+            candidates = sorted(candidates, reverse=True)
+            locations = [(number, self.offsets[number - self.base]) for number in candidates]
+
+        results: List[Dict] = []
+        skipped = 0
+        for number, line in self.room_log.read_lines(locations):
+            if line is None:
+                continue
+            message_sender, _, message = line.rstrip("\n").partition(":")
+            if phrases and not self._contains_phrases(tokenize(message), phrases):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(results) == limit:
+                return results, True
+            results.append({"number": number, "sender": message_sender, "message": message})
+        return results, False
+
+    @staticmethod
+    def _contains_phrases(tokens: List[str], phrases: List[List[str]]) -> bool:
+        for phrase in phrases:
+            size = len(phrase)
+            if not any(tokens[i:i + size] == phrase for i in range(len(tokens) - size + 1)):
+                return False
+        return True
+
+    def save(self) -> None:
+        # add() runs under the room's broadcast lock, so only copy the arrays
+        # (a memcpy each) under the lock and encode them after releasing it
+        with self.lock:
+            base = self.base
+            offsets = self.offsets[:]
+            postings = {term: p[:] for term, p in self.postings.items()}
+        data = {
+            "version": self.version,
+            "base": base,
+            "offsets": _delta_encode(offsets),
+            "postings": {term: _delta_encode(p) for term, p in postings.items()},
+        }
+        payload = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        if not os.path.exists(self.index_folder):
+            os.mkdir(self.index_folder)
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "wb") as f:
+            f.write(payload)
+        os.replace(temp_file, self.index_file)
+
+    def drop(self) -> None:
+        """Forget the index and remove it from disk (used when the room is deleted)."""
+        index_saver.discard(self)
+        with self.lock:
+            self._reset()
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+
+    def _read_index_file(self) -> None:
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            with open(self.index_file, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning("search_index_corrupt", room=self.room_name, error=e)
+            return
+        if data.get("version") != self.version:
+            # older format, rebuilt from the log
+            return
+        self.base = data["base"]
+        self.offsets = _delta_decode(data["offsets"], "Q")
+        self.postings = {term: _delta_decode(p, "I") for term, p in data["postings"].items()}
+
+
+class IndexSaver:
+    """Periodically persists the indexes that changed since they were last saved."""
+
+    def __init__(self, interval: float = 30):
+        self.interval = interval
+        self._dirty: Set[RoomIndex] = set()
+        self._lock = threading.Lock()
+        self.gate = PauseGate()
+        self._thread: Optional[threading.Thread] = None
+
+    def mark_dirty(self, index: RoomIndex) -> None:
+        with self._lock:
+            self._dirty.add(index)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def discard(self, index: RoomIndex) -> None:
+        with self._lock:
+            self._dirty.discard(index)
+
+    def flush(self, index: RoomIndex) -> None:
+        """Save one index now if it has unsaved changes."""
+        with self._lock:
+            if index not in self._dirty:
+                return
+            self._dirty.discard(index)
+        index.save()
+
+    def save_all(self) -> None:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for index in dirty:
+            try:
+                index.save()
+            except OSError as e:
+                logger.warning("search_index_save_failed", room=index.room_name, error=e)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.gate:
+                self.save_all()
+
+
+index_saver = IndexSaver()
+atexit.register(index_saver.save_all)
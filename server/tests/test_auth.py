@@ -0,0 +1,31 @@
+import csv
+import os
+import threading
+import time
+
+import auth
+
+
+def test_concurrent_registrations_of_a_name_store_it_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("database")
+    open("database/users.csv", "w").close()
+
+    def slow_hash(password):
+        # both registrations get past the early existence check while hashing
+        time.sleep(0.1)
+        return "hash-" + password
+
+    monkeypatch.setattr(auth, "hash_password", slow_hash)
+    results = []
+    threads = [
+        threading.Thread(target=lambda password=password: results.append(auth.register_user("a", password, "user")))
+        for password in ("first", "second")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
+    with open("database/users.csv", newline="", encoding="utf-8") as f:
+        assert [row[0] for row in csv.reader(f)] == ["a"]
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from chat_room import ChatRoom
+from room_log import RoomLog
+from search_index import index_saver
+from user_client import UserClient
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.frames = []
+
+    def post(self, data: bytes, priority: int) -> None:
+        self.frames.append(data)
+
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(RoomLog.logs_folder)
+    yield
+    # saved here rather than by the exit hook, which would run in another folder
+    index_saver.save_all()
+
+
+def test_every_connection_of_a_user_is_a_member_until_it_leaves():
+    room = ChatRoom("room")
+    sender = UserClient("a", RecordingConnection())
+    first, second = UserClient("b", RecordingConnection()), UserClient("b", RecordingConnection())
+    for client in (sender, first, second):
+        room.add_client(client)
+    room.broadcast("hi", sender)
+    assert len(first.conn.frames) == len(second.conn.frames) == 1
+    room.remove_client(first)
+    room.broadcast("again", sender)
+    assert len(first.conn.frames) == 1
+    assert len(second.conn.frames) == 2
+    assert room.get_metadata()["members"] == 2
@@ -0,0 +1,57 @@
+import socket
+import time
+
+import pytest
+
+from connection import PRIORITY_BULK, PRIORITY_CHAT, PRIORITY_CONTROL, Connection
+
+
+@pytest.fixture(params=[None, 5.0], ids=["blocking", "timeout"])
+def pair(request):
+    ours, theirs = socket.socketpair()
+    ours.settimeout(request.param)
+    theirs.settimeout(5)
+    conn = Connection(ours)
+    yield conn, theirs
+    conn.close()
+    theirs.close()
+
+
+def read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def wait_for(condition) -> None:
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_post_to_an_idle_connection_is_written_without_a_writer(pair):
+    conn, peer = pair
+    conn.post(b'{"event": "a"}', PRIORITY_CHAT)
+    conn.post(b'{"event": "b"}', PRIORITY_CONTROL)
+    assert conn._outbox is None
+    assert read_exactly(peer, 28) == b'{"event": "a"}{"event": "b"}'
+
+
+def test_writer_finishes_a_frame_and_stops_once_the_outbox_is_empty(pair):
+    conn, peer = pair
+    # more than the socket buffers take, so most of it has to wait for the writer
+    big = b"x" * (2 * 1024 * 1024)
+    conn.post(big, PRIORITY_BULK)
+    conn.post(b"urgent", PRIORITY_CONTROL)
+    assert conn._outbox.writer is not None
+    received = read_exactly(peer, len(big) + len(b"urgent"))
+    # the control frame may not cut into the frame already started
+    assert received == big + b"urgent"
+    wait_for(lambda: conn._outbox.writer is None)
+    conn.post(b"after", PRIORITY_CHAT)
+    assert read_exactly(peer, 5) == b"after"
+    assert conn._outbox.writer is None
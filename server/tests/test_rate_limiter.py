@@ -0,0 +1,64 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter
+
+MESSAGE = {"action": "new_message", "message": "hi"}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_up_to_capacity_then_waits_for_a_token(clock):
+    limiter = RateLimiter(user_bucket=(3, 0.5), ip_bucket=(100, 100), action_costs={})
+    assert [limiter.check(MESSAGE, "a", "ip") for _ in range(3)] == [0, 0, 0]
+    assert limiter.check(MESSAGE, "a", "ip") == pytest.approx(2)
+
+
+def test_tokens_refill_over_time_up_to_capacity(clock):
+    limiter = RateLimiter(user_bucket=(3, 0.5), ip_bucket=(100, 100), action_costs={})
+    for _ in range(3):
+        limiter.check(MESSAGE, "a", "ip")
+    clock[0] += 2
+    assert limiter.check(MESSAGE, "a", "ip") == 0
+    assert limiter.check(MESSAGE, "a", "ip") > 0
+    # a long pause refills no more than the capacity
+    clock[0] += 3600
+    assert [limiter.check(MESSAGE, "a", "ip") for _ in range(3)] == [0, 0, 0]
+    assert limiter.check(MESSAGE, "a", "ip") > 0
+
+
+def test_rejected_requests_cost_nothing(clock):
+    limiter = RateLimiter(user_bucket=(1, 1), ip_bucket=(100, 100), action_costs={})
+    limiter.check(MESSAGE, "a", "ip")
+    clock[0] += 0.5
+    assert limiter.check(MESSAGE, "a", "ip") == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert limiter.check(MESSAGE, "a", "ip") == 0
+
+
+def test_ip_bucket_limits_every_user_behind_the_address(clock):
+    limiter = RateLimiter(user_bucket=(100, 100), ip_bucket=(2, 1), action_costs={})
+    assert limiter.check(MESSAGE, "a", "ip") == 0
+    assert limiter.check(MESSAGE, "b", "ip") == 0
+    assert limiter.check(MESSAGE, "c", "ip") > 0
+    assert limiter.check(MESSAGE, "c", "other ip") == 0
+
+
+def test_batch_messages_are_charged_to_the_batch_bucket(clock):
+    limiter = RateLimiter(
+        user_bucket=(3, 1), ip_bucket=(100, 100), action_costs={"new_messages": 1}, batch_bucket=(10, 5)
+    )
+    batch = {"action": "new_messages", "messages": ["x"] * 4}
+    assert limiter.cost(batch) == 1
+    assert limiter.batch_cost(batch) == 4
+    # more messages than the user bucket holds, fewer than the batch bucket does
+    assert limiter.check(batch, "a", "ip") == 0
+    assert limiter.check(batch, "a", "ip") == 0
+    # the batch bucket has two messages left, the user bucket one token
+    assert limiter.check(batch, "a", "ip") == pytest.approx(0.4)
+    assert limiter.check(MESSAGE, "a", "ip") == 0
@@ -0,0 +1,154 @@
+import os
+
+import pytest
+
+import room_log
+from room_log import LogMaintenance, RoomLog
+
+
+@pytest.fixture(autouse=True)
+def small_segments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(RoomLog.logs_folder)
+    # two 10 byte messages per segment
+    monkeypatch.setattr(room_log, "ROOM_LOG_SEGMENT_BYTES", 20)
+
+
+def fill(log: RoomLog, count: int) -> None:
+    for i in range(count):
+        log.append(f"a: msg{i:03d}\n")
+
+
+def test_maintenance_survives_a_room_deleted_during_compression(monkeypatch):
+    deleted, other = RoomLog("deleted"), RoomLog("other")
+    fill(deleted, 6)
+    fill(other, 6)
+    replace = os.replace
+
+    def replace_then_delete(source, target):
+        replace(source, target)
+        if "deleted" in target:
+            deleted.destroy()
+
+    monkeypatch.setattr(room_log.os, "replace", replace_then_delete)
+    maintenance = LogMaintenance()
+    maintenance.run_once()
+    assert all(segment.compressed for segment in other.segments[:-1])
+    assert not os.path.exists(deleted.folder)
+
+
+def test_read_lines_returns_the_requested_order_reading_forwards(monkeypatch):
+    log = RoomLog("room")
+    locations = [log.append(f"a: msg{i:03d}\n") for i in range(8)]
+    log.compress_cold_segments()
+    seeks = {}
+    open_segment = room_log.Segment.open
+
+    class Recording:
+        def __init__(self, segment):
+            self.file = open_segment(segment)
+            self.offsets = seeks.setdefault(segment.first_number, [])
+
+        def seek(self, offset):
+            self.offsets.append(offset)
+            self.file.seek(offset)
+
+        def readline(self):
+            return self.file.readline()
+
+        def close(self):
+            self.file.close()
+
+    monkeypatch.setattr(room_log.Segment, "open", lambda segment: Recording(segment))
+    newest_first = locations[::-1]
+    lines = list(log.read_lines(newest_first))
+    assert lines == [(number, f"a: msg{number:03d}\n") for number, _ in newest_first]
+    assert all(offsets == sorted(offsets) for offsets in seeks.values())
+
+
+def test_incarnation_survives_reopening_and_changes_when_recreated():
+    log = RoomLog("room")
+    fill(log, 3)
+    incarnation = log.incarnation()
+    assert RoomLog("room").incarnation() == incarnation
+    log.destroy()
+    recreated = RoomLog("room")
+    fill(recreated, 3)
+    assert recreated.incarnation() != incarnation
+    assert recreated.end_number() == 3
+
+
+def test_segments_roll_over_by_size_and_survive_reopening():
+    log = RoomLog("room")
+    fill(log, 5)
+    assert [segment.first_number for segment in log.segments] == [0, 2, 4]
+    reopened = RoomLog("room")
+    assert reopened.end_number() == 5
+    assert [segment.first_number for segment in reopened.segments] == [0, 2, 4]
+    fill(reopened, 1)
+    assert [line for _, _, line in reopened.iter_messages(4)] == ["a: msg004\n", "a: msg000\n"]
+
+
+def test_segments_roll_over_by_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(room_log.time, "time", lambda: now[0])
+    monkeypatch.setattr(room_log, "ROOM_LOG_SEGMENT_BYTES", 1000)
+    monkeypatch.setattr(room_log, "ROOM_LOG_SEGMENT_SECONDS", 60)
+    log = RoomLog("room")
+    fill(log, 2)
+    now[0] += 61
+    fill(log, 1)
+    assert [(segment.first_number, segment.created) for segment in log.segments] == [(0, 1000), (2, 1061)]
+
+
+def test_cold_segments_are_compressed_and_still_readable():
+    log = RoomLog("room")
+    fill(log, 5)
+    log.compress_cold_segments()
+    assert [segment.compressed for segment in log.segments] == [True, True, False]
+    # the uncompressed copies are gone
+    assert sorted(os.listdir(log.folder)) == sorted(os.path.basename(segment.path) for segment in log.segments)
+    expected = [f"a: msg{i:03d}\n" for i in range(5)]
+    assert [line for _, _, line in log.iter_messages()] == expected
+    locations = [(number, offset) for number, offset, _ in log.iter_messages()]
+    assert [line for _, line in log.read_lines(locations)] == expected
+    assert [line for _, _, line in RoomLog("room").iter_messages()] == expected
+
+
+def test_retention_by_size_expires_the_oldest_segments_but_never_the_live_one():
+    log = RoomLog("room")
+    retained = []
+    log.on_retention = retained.append
+    fill(log, 8)
+    # four 20 byte segments
+    log.apply_retention(None, 45)
+    assert [segment.first_number for segment in log.segments] == [4, 6]
+    assert retained == [4]
+    assert [number for number, _, _ in log.iter_messages()] == [4, 5, 6, 7]
+    assert [line for _, line in log.read_lines([(0, 0)])] == [None]
+    log.apply_retention(None, 0)
+    assert [segment.first_number for segment in log.segments] == [6]
+    assert log.end_number() == 8
+
+
+def test_retention_by_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(room_log.time, "time", lambda: now[0])
+    log = RoomLog("room")
+    fill(log, 2)
+    now[0] += 2 * 86400
+    fill(log, 4)
+    log.apply_retention(1, None)
+    assert [segment.first_number for segment in log.segments] == [2, 4]
+
+
+def test_summary_matches_the_opened_log_without_opening_it():
+    assert RoomLog.summary("missing") == (0, None)
+    log = RoomLog("room")
+    fill(log, 7)
+    log.compress_cold_segments()
+    assert RoomLog.summary("room") == (7, log.last_activity())
+    # only the live segment, holding the seventh message, is retained
+    log.apply_retention(None, 0)
+    assert log.message_count() == 1
+    assert RoomLog.summary("room") == (1, log.last_activity())
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+import pytest
+
+import room_registry
+from room_log import open_logs
+from room_registry import RoomRegistry
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("database")
+    registry = RoomRegistry()
+    registry.compact_after = 3
+    registry.load()
+    return registry
+
+
+def reloaded() -> list:
+    registry = RoomRegistry()
+    registry.load()
+    return registry.list()[0]
+
+
+def test_changes_survive_a_restart(registry):
+    registry.create("a")
+    registry.create("b")
+    registry.delete("a")
+    assert reloaded() == ["b"]
+
+
+def test_room_created_on_the_compaction_boundary_is_kept(registry):
+    registry.create("a")
+    registry.create("b")
+    # the third journal entry triggers a compaction
+    registry.create("c")
+    assert not os.path.exists(registry.journal_file)
+    assert reloaded() == ["a", "b", "c"]
+
+
+def test_room_deleted_on_the_compaction_boundary_stays_deleted(registry):
+    registry.create("a")
+    registry.create("b")
+    registry.delete("a")
+    registry.create("c")
+    registry.create("d")
+    # the sixth journal entry triggers the second compaction
+    registry.delete("c")
+    assert reloaded() == ["b", "d"]
+
+
+def test_list_filters_by_prefix_and_pages(registry):
+    for name in ("apple", "apricot", "banana", "avocado"):
+        registry.create(name)
+    assert registry.list("ap") == (["apple", "apricot"], 2)
+    assert registry.list("a", offset=1, limit=1) == (["apricot"], 3)
+    assert registry.list("z") == ([], 0)
+
+
+def test_room_accessed_while_being_evicted_stays_the_same_object(registry):
+    class EvictDuringLookup(dict):
+        def get(self, *args):
+            # evict as soon as the room is looked up, before get() marks it used
+            registry._active = dict(self)
+            evictor = threading.Thread(target=registry.evict_idle)
+            evictor.start()
+            evictor.join(0.5)
+            threads.append(evictor)
+            return dict.get(self, *args)
+
+    threads = []
+    registry.idle_seconds = 0
+    registry.create("a")
+    registry._active = EvictDuringLookup(registry._active)
+    room = registry.get("a")
+    for thread in threads:
+        thread.join()
+    assert registry.get("a") is room
+
+
+def test_slow_materialization_does_not_block_other_rooms(registry, monkeypatch):
+    registry.create("slow")
+    registry.create("other")
+    registry._active.clear()
+    release = threading.Event()
+    built = []
+
+    class SlowRoom(room_registry.ChatRoom):
+        def __init__(self, name):
+            if name == "slow":
+                built.append(name)
+                assert release.wait(5)
+            super().__init__(name)
+
+    monkeypatch.setattr(room_registry, "ChatRoom", SlowRoom)
+    results = []
+    lookups = [threading.Thread(target=lambda: results.append(registry.get("slow"))) for _ in range(2)]
+    for lookup in lookups:
+        lookup.start()
+    while not built:
+        time.sleep(0.01)
+    # the registry lock is free while "slow" loads its log
+    assert registry.get("other").name == "other"
+    assert registry.list() == (["other", "slow"], 2)
+    release.set()
+    for lookup in lookups:
+        lookup.join()
+    assert built == ["slow"]
+    assert results[0] is results[1] is registry.get("slow")
+
+
+def test_room_deleted_while_materializing_is_not_activated(registry, monkeypatch):
+    registry.create("a")
+    registry._active.clear()
+    original = room_registry.ChatRoom
+
+    def delete_while_building(name):
+        # deleting a dormant room builds one too, to remove its log
+        monkeypatch.setattr(room_registry, "ChatRoom", original)
+        registry.delete(name)
+        return original(name)
+
+    monkeypatch.setattr(room_registry, "ChatRoom", delete_while_building)
+    assert registry.get("a") is None
+    assert "a" not in registry._active
+
+
+def test_metadata_does_not_materialize_dormant_rooms(registry):
+    registry.create("a")
+    registry["a"].log_messages(["a: hi", "a: there"])
+    registry.idle_seconds = 0
+    registry.evict_idle()
+    registry._dormant_metadata.clear()
+    registry.create("b")
+    details = registry.metadata(["a", "b", "deleted"])
+    assert "a" not in registry._active
+    assert [(data["name"], data["message_count"]) for data in details] == [("a", 2), ("b", 0)]
+
+
+def test_evicted_room_log_is_no_longer_maintained(registry):
+    log = registry.create("a").log
+    assert log in open_logs
+    registry.idle_seconds = 0
+    registry.evict_idle()
+    assert "a" not in registry._active
+    assert log not in open_logs
+    assert registry["a"].log in open_logs
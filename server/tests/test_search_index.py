@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from room_log import RoomLog
+import search_index
+from search_index import RoomIndex, index_saver
+
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(RoomLog.logs_folder)
+    yield
+    # saved here rather than by the exit hook, which would run in another folder
+    index_saver.save_all()
+
+
+def log_messages(log: RoomLog, index: RoomIndex, lines) -> None:
+    lines = [line + "\n" for line in lines]
+    for (number, offset), line in zip(log.append_many(lines), lines):
+        index.add(number, offset, line)
+
+
+def reloaded(log: RoomLog) -> RoomIndex:
+    """The index as a restarted server loads it, over a log it has not read yet."""
+    index = RoomIndex(log.room_name, RoomLog(log.room_name))
+    index.load()
+    return index
+
+
+def test_saved_index_loads_back_the_same():
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, ["alice:hello world", "bob:Hello there", "alice:the world is big"])
+    index.save()
+    loaded = reloaded(log)
+    assert loaded.base == index.base
+    assert list(loaded.offsets) == list(index.offsets)
+    assert {term: list(p) for term, p in loaded.postings.items()} == {
+        term: list(p) for term, p in index.postings.items()
+    }
+    assert loaded.search("world") == index.search("world")
+    assert [hit["number"] for hit in loaded.search("hello")[0]] == [1, 0]
+    assert loaded.search('"world is"', sender="alice")[0] == [
+        {"number": 2, "sender": "alice", "message": "the world is big"}
+    ]
+
+
+def test_load_only_indexes_messages_the_saved_index_does_not_cover(monkeypatch):
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, [f"alice:message {i}" for i in range(100)])
+    index.save()
+    log.append_many(["bob:late\n"])
+    indexed = []
+    add = RoomIndex._add
+    monkeypatch.setattr(search_index.RoomIndex, "_add", lambda self, number, *args: (
+        indexed.append(number), add(self, number, *args)))
+    loaded = reloaded(log)
+    assert indexed == [100]
+    assert loaded.next_number == 101
+
+
+def test_load_indexes_messages_logged_after_the_save():
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, ["alice:first"])
+    index.save()
+    log.append_many(["bob:second message\n"])
+    loaded = reloaded(log)
+    assert loaded.next_number == 2
+    assert loaded.search("second")[0] == [{"number": 1, "sender": "bob", "message": "second message"}]
+
+
+def test_pruned_messages_stay_pruned_after_a_reload():
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, ["alice:apple", "alice:apple pie", "alice:banana"])
+    index.prune(1)
+    index.save()
+    loaded = reloaded(log)
+    assert loaded.base == 1
+    assert [hit["number"] for hit in loaded.search("apple")[0]] == [1]
+
+
+def test_dropped_index_is_removed_from_disk():
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, ["alice:hello"])
+    index.save()
+    index.drop()
+    assert not os.path.exists(index.index_file)
+    assert index.search("hello") == ([], False)
+
+
+def test_save_encodes_without_holding_the_index_lock(monkeypatch):
+    log = RoomLog("room")
+    index = RoomIndex("room", log)
+    log_messages(log, index, ["alice:hello world"])
+    encode = search_index._delta_encode
+    held = []
+
+    def recording_encode(values):
+        held.append(index.lock.locked())
+        return encode(values)
+
+    monkeypatch.setattr(search_index, "_delta_encode", recording_encode)
+    index.save()
+    assert held and not any(held)
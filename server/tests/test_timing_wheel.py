@@ -0,0 +1,48 @@
+import pytest
+
+import timing_wheel
+from timing_wheel import TimingWheel
+
+
+@pytest.fixture
+def wheel(monkeypatch):
+    monkeypatch.setattr(timing_wheel.time, "monotonic", lambda: 0.0)
+    # one revolution is four seconds
+    return TimingWheel(tick=1.0, slots=4)
+
+
+def test_timer_expires_on_its_tick(wheel):
+    wheel.schedule("a", 2, now=0)
+    assert wheel.advance(1) == []
+    assert wheel.advance(2) == ["a"]
+    assert len(wheel) == 0
+
+
+def test_timer_more_than_a_revolution_away_waits_for_its_lap(wheel):
+    # shares its slot with tick 2, which passes first
+    wheel.schedule("late", 6, now=0)
+    wheel.schedule("early", 2, now=0)
+    assert wheel.advance(5) == ["early"]
+    assert wheel.advance(6) == ["late"]
+
+
+def test_advancing_several_revolutions_at_once_expires_everything_due(wheel):
+    for key, delay in (("a", 1), ("b", 4), ("c", 9)):
+        wheel.schedule(key, delay, now=0)
+    assert sorted(wheel.advance(20)) == ["a", "b", "c"]
+
+
+def test_cancelled_timer_never_expires(wheel):
+    wheel.schedule("a", 2, now=0)
+    wheel.schedule("b", 2, now=0)
+    wheel.cancel("a")
+    wheel.cancel("missing")
+    assert wheel.advance(10) == ["b"]
+    assert len(wheel) == 0
+
+
+def test_rescheduling_replaces_the_previous_timer(wheel):
+    wheel.schedule("a", 2, now=0)
+    wheel.schedule("a", 5, now=0)
+    assert wheel.advance(4) == []
+    assert wheel.advance(5) == ["a"]
@@ -0,0 +1,17 @@
+from traffic_capture import REQUEST, TrafficCapture
+
+
+def test_connection_ids_are_not_reused_after_a_connection_closes():
+    capture = TrafficCapture()
+    capture.running = True
+    first, second, third = object(), object(), object()
+    for conn in (first, second):
+        capture.begin(conn, {"action": "list_users"}, None, None, ())
+        capture.finish(conn)
+    capture.closed(first)
+    capture.begin(third, {"action": "list_users"}, None, None, ())
+    capture.finish(third)
+    records = []
+    while not capture._queue.empty():
+        records.append(capture._queue.get())
+    assert [connection for _, _, connection, kind, _ in records if kind == REQUEST] == [1, 2, 3]
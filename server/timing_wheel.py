@@ -0,0 +1,61 @@
+import math
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Set
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel. Timers are hashed into `slots` buckets by the tick
+    they expire on, so scheduling and cancelling are O(1) and advancing the
+    wheel only looks at the buckets of the ticks that passed (timers more
+    than a full revolution away just stay in their bucket for another lap).
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, int] = {}
+        self._current_tick = self._tick_of(time.monotonic())
+        self._lock = threading.Lock()
+
+    def _tick_of(self, now: float) -> int:
+        return int(now / self.tick)
+
+    def schedule(self, key: Hashable, delay: float, now: Optional[float] = None) -> None:
+        """(Re)arm the timer of `key` to expire `delay` seconds from now."""
+        if now is None:
+            now = time.monotonic()
+        deadline = max(self._tick_of(now) + math.ceil(delay / self.tick), self._current_tick + 1)
+        with self._lock:
+            old_deadline = self._deadlines.get(key)
+            if old_deadline is not None:
+                self._wheel[old_deadline % self.slots].discard(key)
+            self._deadlines[key] = deadline
+            self._wheel[deadline % self.slots].add(key)
+
+    def cancel(self, key: Hashable) -> None:
+        with self._lock:
+            deadline = self._deadlines.pop(key, None)
+            if deadline is not None:
+                self._wheel[deadline % self.slots].discard(key)
+
+    def advance(self, now: Optional[float] = None) -> List[Hashable]:
+        """Move the wheel up to `now` and return the keys whose timers expired."""
+        if now is None:
+            now = time.monotonic()
+        target = self._tick_of(now)
+        expired: List[Hashable] = []
+        with self._lock:
+            while self._current_tick < target:
+                self._current_tick += 1
+                bucket = self._wheel[self._current_tick % self.slots]
+                for key in [k for k in bucket if self._deadlines[k] <= self._current_tick]:
+                    bucket.discard(key)
+                    del self._deadlines[key]
+                    expired.append(key)
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
@@ -0,0 +1,151 @@
+import gzip
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+from connection import Connection
+from logger import logger, redact
+
+MAGIC = b"CHATTRC1"
+# start (seconds since the capture began), duration (seconds), connection id, kind, payload length
+RECORD = struct.Struct("!dfIBI")
+
+# record kinds
+SESSION = 0  # who a connection is logged in as and the rooms it is in
+REQUEST = 1
+EXCHANGE = 2  # JSON sent in the middle of a request, e.g. the file picked for a download
+CLOSED = 3
+
+
+def read_trace(file_path: str) -> Iterator[Tuple[float, float, int, int, Any]]:
+    """Yield (start, duration, connection id, kind, payload) for every record of a trace."""
+    with gzip.open(file_path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_path} is not a traffic capture")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                # the end, or a record cut short by a crash
+                return
+            start, duration, connection, kind, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield start, duration, connection, kind, json.loads(payload)
+
+
+class TrafficCapture:
+    """
+    Records the requests clients send, and how long each took to serve, as a
+    gzip compressed binary trace that traffic_replay.py plays back against
+    another server. Passwords are masked as in the log; file contents never
+    pass through the request loop and are not recorded, only the JSON around
+    them. Like the logger, handler threads only enqueue records, a background
+    thread encodes and writes them.
+    """
+
+    output_folder = "captures"
+
+    def __init__(self):
+        self.running = False
+        self._lock = threading.Lock()
+        self._queue: "queue.SimpleQueue[Optional[Tuple[float, float, int, int, Any]]]" = queue.SimpleQueue()
+        self._started = 0.0
+        # connection -> id in the trace; ids are never reused within a capture
+        self._ids: Dict[Connection, int] = {}
+        self._last_id = 0
+        # connection -> (start, id, redacted request) of the request being served
+        self._in_flight: Dict[Connection, Tuple[float, int, Dict[str, Any]]] = {}
+
+    def start(self, duration: float) -> str:
+        """Capture for `duration` seconds and return the trace file path."""
+        with self._lock:
+            if self.running:
+                raise RuntimeError("A capture is already running")
+            if not os.path.exists(self.output_folder):
+                os.mkdir(self.output_folder)
+            file_path = os.path.join(
+                self.output_folder, time.strftime("capture_%Y%m%d_%H%M%S.trace")
+            )
+            self._queue = queue.SimpleQueue()
+            self._ids.clear()
+            self._last_id = 0
+            self._in_flight.clear()
+            self._started = time.monotonic()
+            self.running = True
+        threading.Thread(target=self._run, args=(self._queue, duration, file_path), daemon=True).start()
+        return file_path
+
+    def begin(self, conn: Connection, request: Dict[str, Any], user_name: Optional[str],
+              role: Optional[str], rooms: Sequence[str]) -> None:
+        """Note a request the calling handler starts serving; recorded once finish() is called."""
+        now = time.monotonic()
+        with self._lock:
+            connection = self._ids.get(conn)
+            if connection is None:
+                self._last_id += 1
+                connection = self._ids[conn] = self._last_id
+                if user_name is not None:
+                    # logged in before the capture started
+                    self._put(now, 0, connection, SESSION, {"username": user_name, "role": role, "rooms": list(rooms)})
+        self._in_flight[conn] = (now, connection, redact(request))
+
+    def finish(self, conn: Connection) -> None:
+        entry = self._in_flight.pop(conn, None)
+        if entry is not None and self.running:
+            start, connection, request = entry
+            self._put(start, time.monotonic() - start, connection, REQUEST, request)
+
+    def session(self, conn: Connection, user_name: str, role: Optional[str]) -> None:
+        """Record a login, so a replay knows which role to give the user."""
+        connection = self._ids.get(conn)
+        if connection is not None:
+            self._put(time.monotonic(), 0, connection, SESSION, {"username": user_name, "role": role, "rooms": []})
+
+    def exchange(self, conn: Connection, message: Dict[str, Any]) -> None:
+        connection = self._ids.get(conn)
+        if connection is not None:
+            self._put(time.monotonic(), 0, connection, EXCHANGE, redact(message))
+
+    def closed(self, conn: Connection) -> None:
+        self.finish(conn)
+        with self._lock:
+            connection = self._ids.pop(conn, None)
+        if connection is not None and self.running:
+            self._put(time.monotonic(), 0, connection, CLOSED, None)
+
+    def _put(self, at: float, duration: float, connection: int, kind: int, payload: Any) -> None:
+        self._queue.put((at - self._started, duration, connection, kind, payload))
+
+    def _run(self, records: "queue.SimpleQueue", duration: float, file_path: str) -> None:
+        deadline = time.monotonic() + duration
+        count = 0
+        stopping = False
+        with gzip.open(file_path, "wb") as f:
+            f.write(MAGIC)
+            while True:
+                if not stopping and time.monotonic() >= deadline:
+                    with self._lock:
+                        self.running = False
+                    # whatever was queued before the capture stopped still goes in
+                    records.put(None)
+                    stopping = True
+                try:
+                    record = records.get(timeout=None if stopping else max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    continue
+                if record is None:
+                    break
+                start, took, connection, kind, payload = record
+                data = json.dumps(payload, separators=(",", ":"), default=str).encode("utf-8")
+                f.write(RECORD.pack(start, took, connection, kind, len(data)))
+                f.write(data)
+                count += 1
+        logger.info("capture_finished", records=count, file_path=file_path)
+
+
+traffic_capture = TrafficCapture()
@@ -0,0 +1,298 @@
+"""
+Replays a traffic capture against a server and reports request latencies.
+
+Start a scratch server with an empty database (and rate limits raised when
+replaying faster than real time), then run from the server folder:
+
+    python traffic_replay.py captures/capture_20260101_120000.trace --speed 4
+
+Every captured connection is replayed on a connection of its own. Each
+request goes out at its captured time divided by --speed, but never before
+the previous request on that connection was answered, so every connection
+sends the same requests in the same order as in the capture. Users and
+rooms the trace uses without creating them are created first. Every user
+gets --password, as the capture does not contain passwords. Uploads send
+zeros of the captured file size instead of the file.
+
+Latency is measured for requests the server answers; chat messages only
+count. The captured column is the time the original server took to serve
+each request. --output saves the report as JSON. --baseline compares it
+with a report saved by an earlier run, e.g. before a change.
+"""
+import argparse
+import json
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from consts import IDLE_TIMEOUT
+from logger import SECRET_FIELDS
+from traffic_capture import CLOSED, EXCHANGE, REQUEST, SESSION, read_trace
+
+REPLY_TIMEOUT = 30
+_decoder = json.JSONDecoder()
+
+
+class ReplyReader:
+    """Picks the replies out of everything a server sends on a connection: replies, events and file chunks."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.replies: "queue.Queue[Tuple[float, Dict[str, Any]]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        buffer = b""
+        skip = 0
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while True:
+                if skip:
+                    skipped = min(skip, len(buffer))
+                    buffer, skip = buffer[skipped:], skip - skipped
+                    if skip:
+                        break
+                buffer = buffer.lstrip()
+                if not buffer:
+                    break
+                try:
+                    # frames are ASCII JSON, latin-1 keeps character and byte offsets equal
+                    frame, end = _decoder.raw_decode(buffer.decode("latin-1"))
+                except json.JSONDecodeError:
+                    # the rest of the frame is still on its way
+                    break
+                buffer = buffer[end:]
+                if "status_code" in frame:
+                    self.replies.put((time.perf_counter(), frame))
+                elif frame.get("event") == "file_chunk":
+                    skip = frame["size"]
+
+    def request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Send a request and wait for its reply."""
+        self.sock.sendall(json.dumps(request).encode("utf-8"))
+        return self.replies.get(timeout=REPLY_TIMEOUT)[1]
+
+
+def with_password(request: Any, password: str) -> Any:
+    """Put the replay password where the capture masked one."""
+    if not isinstance(request, dict):
+        return request
+    return {key: password if key in SECRET_FIELDS else with_password(value, password)
+            for key, value in request.items()}
+
+
+def label(kind: int, request: Dict[str, Any], previous: Optional[str]) -> str:
+    """Name a record is reported under: the action, or the chat command."""
+    if kind == EXCHANGE:
+        return f"{previous} data" if previous else "exchange"
+    action = request.get("action", "?")
+    message = request.get("message")
+    if action == "new_message" and isinstance(message, str) and message.startswith("/"):
+        return f"new_message {message}"
+    return action
+
+
+def expects_reply(name: str) -> bool:
+    return name not in ("new_message", "new_message /exit", "new_message /upload", "new_messages", "exit")
+
+
+def call(reader: ReplyReader, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Send a set up request, waiting out rate limits."""
+    while True:
+        reply = reader.request(request)
+        if "retry_after" not in reply:
+            return reply
+        time.sleep(reply["retry_after"])
+
+
+def set_up(address: Tuple[str, int], records: List[tuple], password: str, admin: str) -> None:
+    """Register the users and create the rooms the trace refers to, unless it registers them itself."""
+    roles: Dict[str, str] = {}
+    registered = set()
+    created = set()
+    rooms = set()
+    for _, _, _, kind, payload in records:
+        if kind == SESSION:
+            roles[payload["username"]] = payload["role"] or "user"
+            rooms.update(payload["rooms"])
+        elif kind == REQUEST:
+            if payload.get("action") == "register":
+                registered.add(payload.get("username"))
+            elif payload.get("action") == "create_chat_room":
+                created.add(payload.get("room_name"))
+            if isinstance(payload.get("room_name"), str):
+                rooms.add(payload["room_name"])
+    for username in registered:
+        roles.pop(username, None)
+    rooms -= created
+    sock = socket.create_connection(address)
+    reader = ReplyReader(sock)
+    call(reader, {"action": "register", "username": admin, "password": password, "role": "admin"})
+    if call(reader, {"action": "login", "username": admin, "password": password})["status_code"] != 200:
+        raise SystemExit(f"Cannot log in as {admin}, is the server's database empty?")
+    for username, role in roles.items():
+        call(reader, {"action": "register", "username": username, "password": password, "role": role})
+    for room_name in rooms:
+        call(reader, {"action": "create_chat_room", "room_name": room_name})
+    sock.sendall(json.dumps({"action": "exit"}).encode("utf-8"))
+    sock.close()
+    print(f"Set up {len(roles)} users and {len(rooms)} rooms")
+
+
+def replay_connection(address: Tuple[str, int], records: List[tuple], password: str, speed: float,
+                      started: float, results: List[tuple]) -> None:
+    """Replay one captured connection, appending (label, replay latency, captured duration, failed) to results."""
+    sock = socket.create_connection(address)
+    reader = ReplyReader(sock)
+    previous = None
+    try:
+        for index, (start, took, _, kind, payload) in enumerate(records):
+            if kind == CLOSED:
+                break
+            if kind == SESSION:
+                if index == 0:
+                    # logged in and in rooms before the capture began
+                    call(reader, {"action": "login", "username": payload["username"], "password": password})
+                    for room_name in payload["rooms"]:
+                        call(reader, {"action": "enter_room", "room_name": room_name})
+                continue
+            name = label(kind, payload, previous)
+            due = started + start / speed
+            while time.perf_counter() < due:
+                time.sleep(max(min(due - time.perf_counter(), IDLE_TIMEOUT / 3), 0))
+                if time.perf_counter() < due:
+                    # the capture leaves heartbeats out, keep idle connections from being reaped
+                    sock.sendall(json.dumps({"action": "ping"}).encode("utf-8"))
+            # replies nobody waited for, e.g. to a rate limited chat message
+            while not reader.replies.empty():
+                reader.replies.get_nowait()
+            sent = time.perf_counter()
+            sock.sendall(json.dumps(with_password(payload, password)).encode("utf-8"))
+            if name == "new_message /upload data" and isinstance(payload.get("size"), int):
+                remaining = payload["size"]
+                while remaining > 0:
+                    chunk = min(remaining, 65536)
+                    sock.sendall(bytes(chunk))
+                    remaining -= chunk
+            captured = took if kind == REQUEST else None
+            if expects_reply(name):
+                try:
+                    answered, reply = reader.replies.get(timeout=REPLY_TIMEOUT)
+                except queue.Empty:
+                    results.append((name, None, captured, True))
+                    break
+                results.append((name, answered - sent, captured, reply.get("status_code") != 200))
+            else:
+                results.append((name, None, captured, False))
+            previous = name
+    except OSError as e:
+        print(f"Connection closed during replay: {e}")
+    finally:
+        sock.close()
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))]
+
+
+def summarize(results: List[tuple]) -> Dict[str, Any]:
+    by_name: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "failed": 0, "replay": [], "captured": []})
+    for name, latency, captured, failed in results:
+        entry = by_name[name]
+        entry["count"] += 1
+        entry["failed"] += failed
+        if latency is not None:
+            entry["replay"].append(latency * 1000)
+        if captured is not None:
+            entry["captured"].append(captured * 1000)
+    report = {}
+    for name, entry in sorted(by_name.items()):
+        report[name] = {
+            "count": entry["count"],
+            "failed": entry["failed"],
+            "replay_ms": {"p50": percentile(entry["replay"], 0.5), "p95": percentile(entry["replay"], 0.95),
+                          "max": max(entry["replay"], default=None)},
+            "captured_ms": {"p50": percentile(entry["captured"], 0.5), "p95": percentile(entry["captured"], 0.95)},
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.2f}"
+
+    def delta(value: Optional[float], before: Optional[float]) -> str:
+        if value is None or before is None:
+            return "-"
+        change = f"{value - before:+.2f}"
+        return change + (f" ({(value - before) / before:+.0%})" if before else "")
+
+    header = f"{'request':<28}{'count':>7}{'failed':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'captured p50':>14}{'p95':>8}"
+    if baseline is not None:
+        header += f"{'p50 vs baseline':>20}{'p95 vs baseline':>20}"
+    print(header)
+    for name, entry in report.items():
+        replay, captured = entry["replay_ms"], entry["captured_ms"]
+        line = (f"{name:<28}{entry['count']:>7}{entry['failed']:>7}{ms(replay['p50']):>9}{ms(replay['p95']):>9}"
+                f"{ms(replay['max']):>9}{ms(captured['p50']):>14}{ms(captured['p95']):>8}")
+        if baseline is not None:
+            before = baseline.get(name, {}).get("replay_ms", {})
+            line += f"{delta(replay['p50'], before.get('p50')):>20}{delta(replay['p95'], before.get('p95')):>20}"
+        print(line)
+
+
+def replay(args: argparse.Namespace) -> None:
+    address = (args.host, args.port)
+    records = sorted(read_trace(args.trace), key=lambda record: record[0])
+    set_up(address, records, args.password, args.admin)
+    connections: Dict[int, List[tuple]] = defaultdict(list)
+    for record in records:
+        connections[record[2]].append(record)
+    results: List[tuple] = []
+    # the replay starts with the first captured request, not with the capture
+    started = time.perf_counter() - (records[0][0] / args.speed if records else 0)
+    threads = [
+        threading.Thread(target=replay_connection, args=(address, connection_records, args.password,
+                                                         args.speed, started, results))
+        for connection_records in connections.values()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"Replayed {len(results)} requests on {len(threads)} connections "
+          f"in {time.perf_counter() - started:.1f}s at {args.speed}x")
+    report = summarize(results)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["requests"]
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"trace": args.trace, "speed": args.speed, "requests": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than captured")
+    parser.add_argument("--password", default="replay", help="password given to every replayed user")
+    parser.add_argument("--admin", default="replay-admin", help="admin account used to create the rooms")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare with")
+    replay(parser.parse_args())
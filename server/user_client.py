@@ -1,9 +1,20 @@
-from collections import deque
-import time
+from typing import Tuple
 
 
 class UserClient:
+    # one per connection in a room, so kept small: no __dict__ and a tuple of rooms
+    __slots__ = ("name", "conn", "rooms")
+
     def __init__(self, name, conn):
         self.name = name
         self.conn = conn
-        self.rolling_last_message_time: deque[time.time] = deque(maxlen=5)
\ No newline at end of file
+        # names of the rooms this connection has joined
+        self.rooms: Tuple[str, ...] = ()
+
+    def join(self, room_name: str) -> None:
+        if room_name not in self.rooms:
+            self.rooms += (room_name,)
+
+    def leave(self, room_name: str) -> None:
+        if room_name in self.rooms:
+            self.rooms = tuple(name for name in self.rooms if name != room_name)